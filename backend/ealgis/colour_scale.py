@@ -2,11 +2,18 @@
 # -*- coding: utf-8 -*-
 
 from collections import namedtuple
-import cairo
 import colorsys
 import csv
+import numpy
+import sys
+import hashlib
+import os
 from cStringIO import StringIO
-from util import pairwise
+try:
+    import simplejson as json
+except ImportError:
+    import json
+from util import pairwise, LRUCache
 
 RGBBase = namedtuple('RGB', ['r', 'g', 'b'])
 
@@ -30,6 +37,11 @@ class ColourScale(object):
         "colour scale @interpolated in [0, 1] normalised, regular.. first is for < scale_min, last is for >= scale_max"
         self.interpolated = interpolated
         self.nlevels = len(self.interpolated)
+        # nlevels x 3 array of RGB components
+        self.palette = numpy.array(self.interpolated, dtype=numpy.float64)
+        # the boundaries between levels in [0, 1] normalised space; the
+        # first level is for values < 0, the last for values >= 1
+        self.unit_breakpoints = numpy.linspace(0., 1., self.nlevels - 1)
         self.nanno = nanno
         self.set_scale(scale_min, scale_max)
         self.is_discrete = is_discrete
@@ -50,29 +62,32 @@ class ColourScale(object):
     def set_scale(self, scale_min, scale_max):
         self.scale_min = float(scale_min)
         self.scale_max = float(scale_max)
-        # matrices to go in and out of that space
-        self.to_scale = cairo.Matrix()
-        self.to_scale.translate(scale_min, 0)
-        self.to_scale.scale(scale_max - scale_min, 1)
-        self.normalise = cairo.Matrix(*self.to_scale)
-        self.normalise.invert()
+        # the level boundaries, in the space of the data
+        self.breakpoints = self.scale_min + self.unit_breakpoints * (self.scale_max - self.scale_min)
 
     def get_nlevels(self):
         return self.nlevels
 
+    def classify(self, values, normalise=True):
+        "index of the level for each of @values (a number, or array-like); if not @normalise, values are in [0, 1] normalised space"
+        breakpoints = self.breakpoints if normalise else self.unit_breakpoints
+        return numpy.searchsorted(breakpoints, numpy.asarray(values, dtype=numpy.float64), side='right')
+
     def lookup(self, v, normalise=True):
-        "v -> [0, 1]"
-        if normalise:
-            v, _ = self.normalise.transform_point(v, 0)
-        if v < 0:
-            idx = 0
-        elif v >= 1:
-            idx = self.nlevels - 1
-        else:
-            idx = int(v * (self.nlevels - 2)) + 1  # eg. 5 levels, 3 "inner"
-        return self.interpolated[idx]
+        return self.interpolated[int(self.classify(v, normalise))]
+
+    def lookup_array(self, values, normalise=True):
+        "colour for each of @values; returns an array of RGB components, shape (len(values), 3)"
+        return self.palette[self.classify(values, normalise)]
+
+    def lookup_argb32(self, values, normalise=True):
+        "colour for each of @values as opaque cairo/pixman ARGB32 pixel values"
+        rgb = numpy.round(self.lookup_array(values, normalise) * 255.).astype(numpy.uint32)
+        return numpy.uint32(0xff000000) | (rgb[:, 0] << 16) | (rgb[:, 1] << 8) | rgb[:, 2]
 
     def legend(self, height=400, width=160):
+        # cairo is only needed to draw legends; don't load it into every process
+        import cairo
         img = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
         cr = cairo.Context(img)
 
@@ -100,14 +115,14 @@ class ColourScale(object):
         v_start = - 1. / (self.nlevels - 2)
         v_end = 1. - v_start
         v_inc = (v_end - v_start) / (legend_height - 1)
-        for i in xrange(legend_height):
-            v = v_end - (v_inc * i)
-            c = self.lookup(v, normalise=False)
-            cr.set_source_rgb(c.r, c.g, c.b)
-            y = legend_from + i + 1.5
-            cr.move_to(1, y)
-            cr.line_to(1 + legend_width, y)
-            cr.stroke()
+        # one row of pixels per value, filled in as a single image
+        row_colours = self.lookup_argb32(v_end - v_inc * numpy.arange(legend_height), normalise=False)
+        pixels = numpy.ascontiguousarray(numpy.repeat(row_colours[:, numpy.newaxis], legend_width, axis=1))
+        gradient = cairo.ImageSurface.create_for_data(
+            pixels, cairo.FORMAT_ARGB32, legend_width, legend_height, legend_width * 4)
+        cr.set_source_surface(gradient, 1, legend_from + 1)
+        cr.rectangle(1, legend_from + 1, legend_width, legend_height)
+        cr.fill()
         # draw annotation
         cr.set_source_rgb(0, 0, 0)
         cr.select_font_face("Inconsolata", cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
@@ -181,9 +196,10 @@ class ContinuousColourScale(ColourScale):
             if idx == npairs - 1:
                 n += nlevel_leftover
                 ninc = n - 1
-            colour_inc = (c2 - c1) / float(ninc)
-            for l in xrange(n):
-                yield c1 + (colour_inc * l)
+            c1, c2 = numpy.array(c1), numpy.array(c2)
+            steps = numpy.arange(n, dtype=numpy.float64)[:, numpy.newaxis] / ninc
+            for colour in (c1 + (c2 - c1) * steps).tolist():
+                yield RGB(*colour)
 
 
 class DiscreteColourScale(ColourScale):
@@ -207,86 +223,203 @@ class HLSDiscreteColourScale(DiscreteColourScale):
         super(HLSDiscreteColourScale, self).__init__(defn)
 
 
+colorbrewer_path = '/app/backend/contrib/colorbrewer/'
+colorbrewer_csv = os.path.join(colorbrewer_path, 'ColorBrewer_all_schemes_RGBonly3.csv')
+# compact form of the CSV, written on first use (or by `colour_scale.py snapshot'); it's kept
+# outside /app, which in development has the source tree mounted over it
+colorbrewer_snapshot = '/data/colorbrewer.json'
+
+
+def read_color_brewer_csv(path):
+    "returns {name: {nlevels: [(r, g, b), ...]}} from the ColorBrewer CSV, components in [0, 255]"
+    def strip_bl(r):
+        return [t for t in r if t != '']
+
+    schemes = {}
+    with open(path) as fd:
+        rdr = csv.reader(fd)
+        header = strip_bl(next(rdr))
+
+        def make_getter(nm, f=str):
+            idx = header.index(nm)
+
+            def __getter(row):
+                return f(row[idx])
+
+            return __getter
+
+        color_name = make_getter('ColorName')
+        num_of_colours = make_getter('NumOfColors', int)
+        rgb = [make_getter(t, int) for t in ('R', 'G', 'B')]
+        for row in rdr:
+            name = color_name(row)
+            if name == '':
+                break
+            nc = num_of_colours(row)
+            colours = [[f(row) for f in rgb]]
+            for i in xrange(nc - 1):
+                row = next(rdr)
+                colours.append([f(row) for f in rgb])
+            schemes.setdefault(name, {})[nc] = colours
+    return schemes
+
+
+def write_color_brewer_snapshot(csv_path=colorbrewer_csv, snapshot_path=colorbrewer_snapshot):
+    "writes the snapshot of the ColorBrewer CSV; returns the schemes, as read_color_brewer_csv"
+    schemes = read_color_brewer_csv(csv_path)
+    # workers may be writing the snapshot at the same time
+    tmp_path = '%s.%d.tmp' % (snapshot_path, os.getpid())
+    with open(tmp_path, 'w') as fd:
+        json.dump(schemes, fd, separators=(',', ':'), sort_keys=True)
+    os.rename(tmp_path, snapshot_path)
+    return schemes
+
+
+def read_color_brewer_snapshot(csv_path=colorbrewer_csv, snapshot_path=colorbrewer_snapshot):
+    "the ColorBrewer schemes, from the snapshot if it is up to date, otherwise from the CSV (writing a new snapshot)"
+    try:
+        if os.path.getmtime(snapshot_path) >= os.path.getmtime(csv_path):
+            with open(snapshot_path) as fd:
+                return json.load(fd)
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        return write_color_brewer_snapshot(csv_path, snapshot_path)
+    except (IOError, OSError):
+        # nowhere to keep the snapshot
+        return read_color_brewer_csv(csv_path)
+
+
 class CannedColourDefinitions(object):
+    "the named colour scales; each scale is built the first time it is asked for"
+    huey_levels = xrange(2, 13)
+
     def __init__(self):
         self.defs = {}
-        self.huey()
-        self.color_brewer()
+        self._color_brewer = None
+
+    def color_brewer(self):
+        if self._color_brewer is None:
+            schemes = read_color_brewer_snapshot()
+            # JSON object keys are always strings
+            self._color_brewer = dict(
+                (name, dict((int(n), colours) for (n, colours) in levels.items()))
+                for (name, levels) in schemes.items())
+        return self._color_brewer
 
     def get_json(self):
-        r = {}
-        for name, nlevels in self.defs:
-            if name not in r:
-                r[name] = []
-            r[name].append(nlevels)
-        for name in r:
-            r[name].sort()
+        r = {"Huey": list(CannedColourDefinitions.huey_levels)}
+        for name, levels in self.color_brewer().items():
+            r[name] = sorted(levels)
         return r
 
     def register(self, name, defn):
         self.defs[(name, defn.get_nlevels())] = defn
 
-    def huey(self):
-        for i in xrange(2, 13):
-            self.register("Huey", HLSDiscreteColourScale((0.5, 0.8), i))
+    def build(self, name, nlevels):
+        if name == "Huey" and nlevels in CannedColourDefinitions.huey_levels:
+            return HLSDiscreteColourScale((0.5, 0.8), nlevels)
+        colours = self.color_brewer()[name][nlevels]
+        return DiscreteColourScale([RGB(r / 255., g / 255., b / 255.) for (r, g, b) in colours])
 
     def get(self, name, nlevels):
-        return self.defs[(name, nlevels)]
-
-    def color_brewer(self):
-        def strip_bl(r):
-            return [t for t in r if t != '']
-
-        with open('/app/backend/contrib/colorbrewer/ColorBrewer_all_schemes_RGBonly3.csv') as fd:
-            rdr = csv.reader(fd)
-            header = strip_bl(next(rdr))
-
-            def make_getter(nm, f=str):
-                idx = header.index(nm)
-
-                def __getter(row):
-                    return f(row[idx])
-
-                return __getter
-
-            color_name = make_getter('ColorName')
-            num_of_colours = make_getter('NumOfColors', int)
-            r = make_getter('R', lambda v: int(v) / 255.)
-            g = make_getter('G', lambda v: int(v) / 255.)
-            b = make_getter('B', lambda v: int(v) / 255.)
-            for row in rdr:
-                name = color_name(row)
-                if name == '':
-                    break
-                nc = num_of_colours(row)
-                colours = []
-                colours.append(RGB(r(row), g(row), b(row)))
-                for i in xrange(nc - 1):
-                    row = next(rdr)
-                    colours.append(RGB(r(row), g(row), b(row)))
-                self.register(name, DiscreteColourScale(colours))
+        key = (name, nlevels)
+        defn = self.defs.get(key)
+        if defn is None:
+            defn = self.build(name, nlevels)
+            self.register(name, defn)
+        return defn
 
 definitions = CannedColourDefinitions()
 
 
-def colour_for_layer(defn):
+def scale_parameters(defn):
+    "the parameters which determine a layer's colour scale: (name, nlevels, min, max, flip)"
     fill = defn['fill']
-    scale_min = float(fill['scale_min'])
-    scale_max = float(fill['scale_max'])
-    scale_name = fill['scale_name']
-    scale_nlevels = int(fill['scale_nlevels'])
-    scale_flip = 'scale_flip' in fill and fill['scale_flip']
-    scale = ColourScale.with_scale_or_flip(
+    return (
+        fill['scale_name'],
+        int(fill['scale_nlevels']),
+        float(fill['scale_min']),
+        float(fill['scale_max']),
+        bool('scale_flip' in fill and fill['scale_flip']))
+
+
+def colour_for_parameters(scale_name, scale_nlevels, scale_min, scale_max, scale_flip):
+    return ColourScale.with_scale_or_flip(
         definitions.get(scale_name, scale_nlevels),
         scale_min, scale_max,
         scale_flip)
-    return scale
+
+
+def colour_for_layer(defn):
+    return colour_for_parameters(*scale_parameters(defn))
+
+
+class LegendCache(object):
+    "rendered legend PNGs, keyed on colour scale parameters; held in memory, and on disk"
+    # bump to invalidate legends rendered by older code
+    epoch = 1
+
+    def __init__(self, path, maxsize=256, disk_maxsize=4096):
+        self.path = path
+        self.memory = LRUCache(maxsize)
+        self.disk_maxsize = disk_maxsize
+
+    def etag(self, params):
+        return hashlib.sha1(repr((LegendCache.epoch, ) + tuple(params))).hexdigest()
+
+    def _disk_path(self, etag):
+        return os.path.join(self.path, etag + '.png')
+
+    def _disk_get(self, etag):
+        path = self._disk_path(etag)
+        try:
+            with open(path, 'rb') as fd:
+                png = fd.read()
+            # mark as recently used
+            os.utime(path, None)
+            return png
+        except (IOError, OSError):
+            return None
+
+    def _disk_put(self, etag, png):
+        path = self._disk_path(etag)
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            with open(path + '.%d.tmp' % (os.getpid()), 'wb') as fd:
+                fd.write(png)
+            os.rename(path + '.%d.tmp' % (os.getpid()), path)
+            entries = [os.path.join(self.path, t) for t in os.listdir(self.path) if t.endswith('.png')]
+            if len(entries) > self.disk_maxsize:
+                entries.sort(key=os.path.getmtime)
+                for entry in entries[:len(entries) - self.disk_maxsize]:
+                    os.unlink(entry)
+        except (IOError, OSError):
+            # the disk cache is an optimisation only
+            pass
+
+    def get(self, params):
+        "returns (etag, png) for the legend of a colour scale with @params (see scale_parameters)"
+        etag = self.etag(params)
+        png = self.memory.get(etag)
+        if png is None:
+            png = self._disk_get(etag)
+            if png is None:
+                png = colour_for_parameters(*params).legend()
+                self._disk_put(etag, png)
+            self.memory.put(etag, png)
+        return etag, png
+
+legends = LegendCache('/data/legend_cache/')
 
 if __name__ == '__main__':
-    scale = definitions.get("Accent", 8)
-    with open('html/accent.png', 'w') as fd:
-        fd.write(scale.legend())
-    scale = definitions.get("Huey", 8)
-    with open('html/huey.png', 'w') as fd:
-        fd.write(scale.legend())
-    definitions.to_json()
+    if sys.argv[1:] == ['snapshot']:
+        write_color_brewer_snapshot()
+    else:
+        scale = definitions.get("Accent", 8)
+        with open('html/accent.png', 'w') as fd:
+            fd.write(scale.legend())
+        scale = definitions.get("Huey", 8)
+        with open('html/huey.png', 'w') as fd:
+            fd.write(scale.legend())
@@ -5,6 +5,7 @@ import csv
 from decimal import Decimal
 from StringIO import StringIO
 from db import MapDefinition
+import prepared
 
 
 def export_iter(defn_obj, bounds=None):
@@ -19,7 +20,7 @@ def export_iter(defn_obj, bounds=None):
         geom_source = expr.get_geometry_source()
         if geom_source not in expressions:
             expressions[geom_source] = []
-        expressions[geom_source].append(expr)
+        expressions[geom_source].append((layer, expr))
 
     def next_or_none(it):
         try:
@@ -27,16 +28,20 @@ def export_iter(defn_obj, bounds=None):
         except StopIteration:
             return None, None
 
-    if bounds is None:
-        mkq = lambda q: q.get_query()
-    else:
-        mkq = lambda q: q.get_query_bounds(*bounds, srid=4326)
+    def execute(layer, expr):
+        if bounds is None:
+            # the whole geometry source; streamed through a server-side cursor, rather than held in memory
+            return expr.get_query().yield_per(1)
+        # the bounds are parameters of a prepared statement, reused between exports of the layer
+        key = (defn_obj.id, layer, layers[layer].get('hash'), 'export')
+        sql = prepared.statement_sql(key, lambda: expr.get_query_bounds(*prepared.bounds_placeholders, srid=4326))
+        return prepared.execute(sql, prepared.bounds_parameters(bounds))
 
     # for each geometry, yield a header and then the data for each geom in the geometry
     for geom_source in expressions:
         queries = expressions[geom_source]
-        yield [geom_source.table_info.name] + [q.get_name() for q in queries]
-        iters = [iter(mkq(q).yield_per(1)) for q in queries]
+        yield [geom_source.table_info.name] + [q.get_name() for (_, q) in queries]
+        iters = [iter(execute(layer, q)) for (layer, q) in queries]
         vals = [next_or_none(i) for i in iters]
         while True:
             # figure the minimum gid in these results
@@ -5,11 +5,17 @@
 #
 
 import sqlalchemy
+from sqlalchemy.sql import visitors
+from collections import OrderedDict
+import operator
+import math
 import sys
-from pyparsing import Word, nums, alphanums, Combine, oneOf, Optional, \
-    opAssoc, operatorPrecedence
-import ealgis
-eal = ealgis.EAlGIS()
+from pyparsing import Word, nums, alphas, alphanums, Combine, oneOf, Optional, \
+    opAssoc, operatorPrecedence, Forward, Suppress, CaselessKeyword, delimitedList, \
+    ParseException
+from db import EAlGIS, GeometryIntersection
+import metrics
+eal = EAlGIS()
 
 
 def printquery(query):
@@ -31,12 +37,32 @@ def operatorOperands(tokenlist):
             break
 
 
-class EvalConstant():
+class EvalNode(object):
+    "base class of the nodes of a parsed expression"
+    def eval(self, expr_state):
+        # goes via the scope, so that repeated subexpressions are only computed once
+        return expr_state.evaluate(self)
+
+    def children(self):
+        return []
+
+    def key(self):
+        "identifies the subexpression; nodes with equal keys evaluate to the same value"
+        return (self.__class__.__name__, ) + tuple(t.key() for t in self.children())
+
+    def size(self):
+        return 1 + sum(t.size() for t in self.children())
+
+
+class EvalConstant(EvalNode):
     "Class to evaluate a parsed constant or variable"
     def __init__(self, tokens):
         self.value = tokens[0]
 
-    def eval(self, expr_state):
+    def key(self):
+        return ('EvalConstant', self.value.lower())
+
+    def evaluate(self, expr_state):
         try:
             return int(self.value)
         except ValueError:
@@ -48,109 +74,443 @@ class EvalConstant():
         return expr_state.lookup(self.value)
 
 
-class EvalSignOp():
+def is_sql(v):
+    "is @v a SQL expression (rather than a Python number)?"
+    # mapped attributes (eg. table columns) aren't themselves clause elements, but provide one
+    return isinstance(v, sqlalchemy.sql.ClauseElement) or hasattr(v, '__clause_element__')
+
+
+def nonzero(v):
+    "@v, or NULL if @v is zero; dividing by NULL gives NULL rather than an error"
+    if is_sql(v):
+        return sqlalchemy.func.nullif(v, 0)
+    if v == 0:
+        return sqlalchemy.null()
+    return v
+
+
+def is_boolean(v):
+    "is @v a SQL expression of boolean type, eg. a comparison?"
+    return is_sql(v) and isinstance(getattr(v, 'type', None), sqlalchemy.Boolean)
+
+
+def number(v):
+    "@v as a number; Postgres won't do arithmetic on booleans (eg. from isnull()), so they become 1 or 0"
+    if is_boolean(v):
+        return sqlalchemy.cast(v, sqlalchemy.Integer)
+    return v
+
+
+class EvalNull(EvalNode):
+    "Class to evaluate the null constant"
+    def __init__(self, tokens):
+        pass
+
+    def evaluate(self, expr_state):
+        return sqlalchemy.null()
+
+
+def _guarded(fn, valid):
+    "@fn, giving NULL where @valid(x) doesn't hold; Postgres raises an error, eg. for log(0)"
+    def _fn(x):
+        return sqlalchemy.case([(valid(x), fn(x))], else_=sqlalchemy.null())
+    return _fn
+
+
+def _checked(fn, valid):
+    "Python equivalent of _guarded"
+    def _fn(x):
+        return fn(x) if valid(x) else sqlalchemy.null()
+    return _fn
+
+
+def _round(x, places=0):
+    # round(x, places) is only defined for numeric
+    return sqlalchemy.func.round(sqlalchemy.cast(x, sqlalchemy.Numeric), places)
+
+
+def _isnull(x):
+    # IS NULL is untyped in SQLAlchemy, but we need to know the result is boolean (see number())
+    return sqlalchemy.type_coerce(x == None, sqlalchemy.Boolean)  # noqa
+
+
+def _if(cond, then, otherwise=None):
+    if otherwise is None:
+        otherwise = sqlalchemy.null()
+    return sqlalchemy.case([(cond, then)], else_=otherwise)
+
+
+class EvalFunction(EvalNode):
+    "Class to evaluate function calls"
+    # name -> (function, Python equivalent used when all arguments are constant (or None),
+    #          minimum arguments, maximum arguments (None for no limit))
+    functions = {
+        'abs': (sqlalchemy.func.abs, abs, 1, 1),
+        'sqrt': (_guarded(sqlalchemy.func.sqrt, lambda x: x >= 0), _checked(math.sqrt, lambda x: x >= 0), 1, 1),
+        'log': (_guarded(sqlalchemy.func.log, lambda x: x > 0), _checked(math.log10, lambda x: x > 0), 1, 1),
+        'ln': (_guarded(sqlalchemy.func.ln, lambda x: x > 0), _checked(math.log, lambda x: x > 0), 1, 1),
+        'round': (_round, lambda x, places=0: round(x, places), 1, 2),
+        'min': (sqlalchemy.func.least, min, 1, None),
+        'max': (sqlalchemy.func.greatest, max, 1, None),
+        'coalesce': (sqlalchemy.func.coalesce, lambda *args: args[0], 1, None),
+        'nullif': (sqlalchemy.func.nullif, lambda a, b: sqlalchemy.null() if a == b else a, 2, 2),
+        'isnull': (_isnull, lambda x: False, 1, 1),
+        'if': (_if, None, 2, 3),
+    }
+
+    # aggregates over another geometry source: name -> function. called as
+    # sum_within(geometry, expression), the expression being evaluated against that geometry
+    aggregates = {
+        'sum_within': sqlalchemy.func.sum,
+    }
+
+    def __init__(self, tokens):
+        self.name = tokens[0].lower()
+        self.args = tokens[1:]
+
+    def children(self):
+        return list(self.args)
+
+    def key(self):
+        return ('EvalFunction', self.name) + tuple(t.key() for t in self.args)
+
+    def evaluate(self, expr_state):
+        if self.name in EvalFunction.aggregates:
+            if len(self.args) != 2 or not isinstance(self.args[0], EvalConstant):
+                raise ParseException(self.name, 0, "`%s' takes a geometry and an expression" % (self.name))
+            return expr_state.aggregate_within(self.args[0].value, self.args[1], EvalFunction.aggregates[self.name])
+        if self.name not in EvalFunction.functions:
+            raise ParseException(self.name, 0, "unknown function `%s'" % (self.name))
+        fn, py_fn, min_args, max_args = EvalFunction.functions[self.name]
+        if len(self.args) < min_args or (max_args is not None and len(self.args) > max_args):
+            raise ParseException(self.name, 0, "wrong number of arguments to `%s'" % (self.name))
+        if self.name == 'if':
+            cond = self.args[0].eval(expr_state)
+            if not is_sql(cond):
+                # only the branch taken is evaluated, so the other's attributes aren't joined
+                if cond:
+                    return self.args[1].eval(expr_state)
+                return self.args[2].eval(expr_state) if len(self.args) > 2 else sqlalchemy.null()
+            return fn(cond, *[number(t.eval(expr_state)) for t in self.args[1:]])
+        args = [number(t.eval(expr_state)) for t in self.args]
+        if py_fn is not None and not any(is_sql(t) for t in args):
+            return py_fn(*args)
+        return fn(*args)
+
+
+class EvalSignOp(EvalNode):
     "Class to evaluate expressions with a leading + or - sign"
     def __init__(self, tokens):
         self.sign, self.value = tokens[0]
 
-    def eval(self, expr_state):
-        mult = {'+': 1, '-': -1}[self.sign]
-        return mult * self.value.eval(expr_state)
+    def children(self):
+        return [self.value]
 
+    def key(self):
+        return ('EvalSignOp', self.sign, self.value.key())
 
-class EvalMultOp():
-    "Class to evaluate multiplication and division expressions"
-    def __init__(self, tokens):
-        self.value = tokens[0]
+    def evaluate(self, expr_state):
+        if self.sign == '-':
+            return -number(self.value.eval(expr_state))
+        return self.value.eval(expr_state)
 
-    def eval(self, expr_state):
-        prod = self.value[0].eval(expr_state)
-        for op, val in operatorOperands(self.value[1:]):
-            if op == '*':
-                prod *= val.eval(expr_state)
-            if op == '/':
-                evaled = val.eval(expr_state)
-                # add an implicit divide-by-zero filter
-                if str(type(evaled)).find('sqlalchemy.') != -1:  # ultimate bodge, FIXME
-                    expr_state.add_filter(evaled != 0)
-                prod /= sqlalchemy.cast(evaled, sqlalchemy.Float)
-            if op == '//':
-                prod //= val.eval(expr_state)
-            if op == '%':
-                prod %= val.eval(expr_state)
-        return prod
-
-
-class EvalAddOp():
-    "Class to evaluate addition and subtraction expressions"
+
+def fold(operands, fn, identity):
+    """combine @operands with the associative and commutative @fn; the constant operands are
+    combined in Python, and the result put first (and left out if it is @identity)"""
+    constant = reduce(fn, [t for t in operands if not is_sql(t)], identity)
+    sql = [t for t in operands if is_sql(t)]
+    if not sql:
+        return constant
+    if constant != identity:
+        sql.insert(0, constant)
+    return reduce(fn, sql)
+
+
+class EvalBinaryOp(EvalNode):
+    "base class of the arithmetic operators; chains (a + b + c) become nested pairs ((a + b) + c)"
     def __init__(self, tokens):
-        self.value = tokens[0]
+        value = list(tokens[0])
+        if len(value) > 3:
+            value = [self.__class__([value[:-2]])] + value[-2:]
+        self.left, self.op, self.right = value
 
-    def eval(self, expr_state):
-        sum = self.value[0].eval(expr_state)
-        for op, val in operatorOperands(self.value[1:]):
-            if op == '+':
-                sum += val.eval(expr_state)
-            if op == '-':
-                sum -= val.eval(expr_state)
-        return sum
+    def children(self):
+        return [self.left, self.right]
+
+    def key(self):
+        return (self.__class__.__name__, self.left.key(), self.op, self.right.key())
+
+    def chain(self, expr_state, node):
+        """values of the operands of @node, looking through nested uses of our (associative) operator;
+        so that constants anywhere in the chain may be folded together"""
+        if isinstance(node, self.__class__) and node.op == self.op and node.key() not in expr_state.shared:
+            return self.chain(expr_state, node.left) + self.chain(expr_state, node.right)
+        return [number(node.eval(expr_state))]
+
+
+class EvalMultOp(EvalBinaryOp):
+    "Class to evaluate multiplication and division expressions"
+    def evaluate(self, expr_state):
+        if self.op == '*':
+            return fold(self.chain(expr_state, self.left) + self.chain(expr_state, self.right), operator.mul, 1)
+        val1 = number(self.left.eval(expr_state))
+        val2 = number(self.right.eval(expr_state))
+        constant = not is_sql(val1) and not is_sql(val2)
+        if self.op == '/':
+            # division by zero gives NULL
+            if not is_sql(val2):
+                if val2 == 0:
+                    return sqlalchemy.null()
+                return val1 / float(val2)
+            return val1 / sqlalchemy.cast(nonzero(val2), sqlalchemy.Float)
+        if self.op == '//':
+            if constant:
+                return val1 // val2 if val2 != 0 else sqlalchemy.null()
+            return sqlalchemy.func.floor(sqlalchemy.cast(val1, sqlalchemy.Float) / nonzero(val2))
+        if self.op == '%':
+            if constant:
+                # the sign of the result follows the dividend in Postgres, but the divisor in Python
+                if val1 >= 0 and val2 > 0:
+                    return val1 % val2
+                val1 = sqlalchemy.literal(val1)
+            return val1 % nonzero(val2)
+
+
+class EvalAddOp(EvalBinaryOp):
+    "Class to evaluate addition and subtraction expressions"
+    def evaluate(self, expr_state):
+        if self.op == '+':
+            return fold(self.chain(expr_state, self.left) + self.chain(expr_state, self.right), operator.add, 0)
+        return number(self.left.eval(expr_state)) - number(self.right.eval(expr_state))
 
 
-class EvalComparisonOp():
+class EvalComparisonOp(EvalNode):
     "Class to evaluate comparison expressions"
+    # the operator module, unlike int, handles comparisons with a SQL expression on the right
     fn_map = {
-        "<": '__lt__',
-        "<=": '__le__',
-        ">": '__gt__',
-        ">=": '__ge__',
-        "==": '__eq__',
-        "!=": '__ne__'}
+        "<": operator.lt,
+        "<=": operator.le,
+        ">": operator.gt,
+        ">=": operator.ge,
+        "==": operator.eq,
+        "!=": operator.ne,
+        "<>": operator.ne}
 
     def __init__(self, tokens):
         self.value = tokens[0]
 
-    def eval(self, expr_state):
+    def children(self):
+        return self.value[0::2]
+
+    def key(self):
+        return ('EvalComparisonOp', ) + tuple(t if isinstance(t, basestring) else t.key() for t in self.value)
+
+    def evaluate(self, expr_state):
         val1 = self.value[0].eval(expr_state)
         for op, val in operatorOperands(self.value[1:]):
-            fn = getattr(val1, EvalComparisonOp.fn_map[op])
             val2 = val.eval(expr_state)
-            val1 = fn(val2)
+            val1 = EvalComparisonOp.fn_map[op](number(val1), number(val2))
         return val1
 
 
-class EvalLogicalOp():
+class EvalLogicalOp(EvalNode):
     "Class to evaluate comparison expressions"
     fn_map = {
-        "||": '__or__',
-        "&&": '__and__'}
+        "||": (sqlalchemy.or_, lambda a, b: a or b),
+        "&&": (sqlalchemy.and_, lambda a, b: a and b)}
 
     def __init__(self, tokens):
         self.value = tokens[0]
 
-    def eval(self, expr_state):
+    def children(self):
+        return self.value[0::2]
+
+    def key(self):
+        return ('EvalLogicalOp', ) + tuple(t if isinstance(t, basestring) else t.key() for t in self.value)
+
+    def evaluate(self, expr_state):
         val1 = self.value[0].eval(expr_state)
         for op, val in operatorOperands(self.value[1:]):
-            fn = getattr(val1, EvalLogicalOp.fn_map[op])
+            fn, py_fn = EvalLogicalOp.fn_map[op]
             val2 = val.eval(expr_state)
-            val1 = fn(val2)
+            if is_sql(val1) or is_sql(val2):
+                val1 = fn(val1, val2)
+            else:
+                val1 = py_fn(val1, val2)
         return val1
 
 
-class DataExpression(object):
+def common_subexpressions(trees):
+    "keys of the subexpressions, worth computing once, which occur more than once in the parsed @trees"
+    counts = {}
+
+    def _count(node):
+        # a variable, or a variable with a sign, is no cheaper to reuse than to repeat
+        if node.size() <= 2:
+            return
+        key = node.key()
+        counts[key] = counts.get(key, 0) + 1
+        # the subexpressions of a repeat are computed along with it
+        if counts[key] == 1:
+            for child in node.children():
+                _count(child)
+    for tree in trees:
+        _count(tree)
+    return set(key for (key, count) in counts.items() if count > 1)
+
+
+def referenced_tables(clauses):
+    "the tables (and subqueries) with columns in the SQL expressions @clauses"
+    tables = set()
+    for clause in clauses:
+        if not is_sql(clause):
+            continue
+        if hasattr(clause, '__clause_element__'):
+            clause = clause.__clause_element__()
+        for element in visitors.iterate(clause, {}):
+            table = getattr(element, 'table', None)
+            if isinstance(table, sqlalchemy.sql.expression.Lateral):
+                # the lateral subqueries of shared subexpressions refer to the tables of the enclosing query
+                tables |= referenced_tables(table.element.inner_columns)
+            elif table is not None:
+                tables.add(table)
+    return tables
+
+
+def join_table(tbl):
+    "the table (or subquery) of @tbl, a mapped class or subquery"
+    return getattr(tbl, '__table__', tbl)
+
+
+class ExpressionScope(object):
+    "the geometry source that the attributes in an expression are resolved against, and the joins this requires"
+    def __init__(self, geometry_source):
+        self.geometry_source = geometry_source
+        self.table_instances = {}
+        # (table, join column, our column) -> estimated rows in the table (None if unknown)
+        self.joins = OrderedDict()
+        self.attributes = {}
+        # keys of subexpressions to compute once (see common_subexpressions), their values,
+        # and the lateral subqueries computing them
+        self.shared = set()
+        self.shared_values = {}
+        self.laterals = []
+        self.tbl = self.get_table_class(geometry_source.table_info.name)
+
+    def get_table_class(self, table_name):
+        if table_name not in self.table_instances:
+            self.table_instances[table_name] = eal.get_table_class(table_name)
+        return self.table_instances[table_name]
+
+    def evaluate(self, node):
+        key = node.key()
+        if key not in self.shared:
+            return node.evaluate(self)
+        if key not in self.shared_values:
+            value = node.evaluate(self)
+            # constants, and columns (eg. of an aggregate's subquery), are used as they are
+            if is_sql(value) and not isinstance(value, sqlalchemy.sql.expression.ColumnClause):
+                select = sqlalchemy.select([value.label('v')])
+                # correlated with the tables of the enclosing query
+                lateral = select.correlate(*select.froms).lateral('cse_%d' % (len(self.laterals) + 1))
+                self.laterals.append(lateral)
+                value = lateral.c.v
+            self.shared_values[key] = value
+        return self.shared_values[key]
+
+    def lookup(self, attr_name):
+        # attribute names are case insensitive
+        key = attr_name.lower()
+        if key not in self.attributes:
+            self.attributes[key] = self.resolve(attr_name)
+        return self.attributes[key]
+
+    def resolve(self, attr_name):
+        attr_column_linkage, attr_column_info = eal.resolve_attribute(self.geometry_source, attr_name)
+        # wide tables may be split over several physical tables
+        attr_tbl = self.get_table_class(eal.column_table(attr_column_info))
+        attr_attr = getattr(attr_tbl, attr_column_info.name)
+        # and our join columns
+        attr_linkage = getattr(attr_tbl, attr_column_linkage.attr_column)
+        tbl_linkage = getattr(self.tbl, attr_column_linkage.geo_column)
+        statistics = attr_column_info.statistics
+        self.joins[(attr_tbl, attr_linkage, tbl_linkage)] = statistics.row_count if statistics is not None else None
+        return attr_attr
+
+    def apply_joins(self, query, inner, outer):
+        """join to @query the tables referred to by the SQL expressions @inner (eg. conditions) and @outer (eg. the
+        value computed). joins which aren't needed are left out. tables only referred to by @outer are left joined;
+        features without a row in them get NULL values rather than disappearing (they are left out of the query
+        MapServer draws from, see get_mapserver_query), and Postgres must join them after the features are
+        selected. the inner joins come first, the smallest table (by catalog statistics) first"""
+        inner_tables = referenced_tables(inner)
+        outer_tables = referenced_tables(outer) - inner_tables
+        joins = [(t, rows) for (t, rows) in self.joins.items() if join_table(t[0]) in inner_tables | outer_tables]
+
+        def _order(entry):
+            (tbl, _, _), rows = entry
+            return (join_table(tbl) in outer_tables, rows is None, rows)
+        for (tbl, join_l, join_r), _ in sorted(joins, key=_order):
+            if join_table(tbl) in outer_tables:
+                query = query.outerjoin(tbl, join_l == join_r)
+            else:
+                query = query.join(tbl, join_l == join_r)
+        # after the joins, as they refer to the joined tables
+        for lateral in self.laterals:
+            query = query.join(lateral, sqlalchemy.true())
+        return query
+
+    def aggregate_within(self, source_name, value, fn):
+        """aggregate (with @fn, eg. func.sum) the parsed expression @value, evaluated over the features of the
+        geometry source @source_name, up to our features. each value is weighted by the proportion of its feature
+        that lies within ours, from the intersections computed by `ealgis georelate'"""
+        try:
+            child_source = eal.get_geometry_source(source_name)
+        except sqlalchemy.orm.exc.NoResultFound:
+            raise ParseException(source_name, 0, "unknown geometry `%s'" % (source_name))
+        relation = eal.get_geometry_relation(child_source, self.geometry_source)
+        if relation is None:
+            raise ParseException(source_name, 0, "intersections of `%s' with `%s' have not been computed (see `ealgis georelate')" % (
+                source_name, self.geometry_source.table_info.name))
+        child = ExpressionScope(child_source)
+        child.shared = common_subexpressions([value])
+        child_value = number(value.eval(child))
+        isect = sqlalchemy.orm.aliased(GeometryIntersection)
+        q = eal.db.session.query(
+            isect.with_gid.label('gid'),
+            fn(child_value * isect.percentage_overlap / 100.).label('v')).join(
+            child.tbl, getattr(child.tbl, child_source.gid) == isect.gid)
+        # the aggregate ignores the NULLs of children without attribute data, as if they'd been left out
+        q = child.apply_joins(q, [], [child_value])
+        aggregated = q.filter(isect.geometry_relation_id == relation.id).group_by(isect.with_gid).subquery()
+        self.joins[(aggregated, aggregated.c.gid, getattr(self.tbl, self.geometry_source.gid))] = None
+        return aggregated.c.v
+
+
+class DataExpression(ExpressionScope):
     integer = Word(nums)
     real = (Combine(Word(nums) + Optional("." + Word(nums))
             + oneOf("E e") + Optional(oneOf('+ -')) + Word(nums))
             | Combine(Word(nums) + "." + Word(nums)))
 
     variable = Word(alphanums + '._')
-    operand = real | integer | variable
+    null = CaselessKeyword('null')
+    # function arguments may be any expression, including comparisons
+    argument = Forward()
+    function_call = Word(alphas, alphanums + '_') + Suppress('(') + Optional(delimitedList(argument)) + Suppress(')')
+    operand = function_call | real | integer | null | variable
 
     signop = oneOf('+ -')
     multop = oneOf('* / // %')
     plusop = oneOf('+ -')
     comparisonop = oneOf("< <= > >= == != <>")
     logicalop = oneOf("|| &&")
-    operand.setParseAction(EvalConstant)
+    real.setParseAction(EvalConstant)
+    integer.setParseAction(EvalConstant)
+    variable.setParseAction(EvalConstant)
+    null.setParseAction(EvalNull)
+    function_call.setParseAction(EvalFunction)
     arith_expr = operatorPrecedence(
         operand,
         [(signop, 1, opAssoc.RIGHT, EvalSignOp),
@@ -165,10 +525,12 @@ class DataExpression(object):
          (comparisonop, 2, opAssoc.LEFT, EvalComparisonOp),
          (logicalop, 2, opAssoc.LEFT, EvalLogicalOp),
          ])
+    argument << cond_expr
 
+    @metrics.timed('expression_compile')
     def __init__(self, name, geometry_source, expr, cond, srid=None, include_geometry=True, order_by_gid=False):
+        super(DataExpression, self).__init__(geometry_source)
         self.name = name
-        self.geometry_source = geometry_source
         self.geometry_column = None
         self.srid = srid
         # attempt to get a column in the desired SRID, this speeds things up
@@ -177,11 +539,6 @@ class DataExpression(object):
         if self.geometry_column is None:
             self.geometry_column = self.geometry_source.column
             self.srid = self.geometry_source.srid
-        self.table_instances = {}
-        self.filters = []
-
-        self.joins = set()
-        self.tbl = self.get_table_class(geometry_source.table_info.name)
 
         query_attrs = []
         if include_geometry:
@@ -195,22 +552,32 @@ class DataExpression(object):
             expr = sqlalchemy.func.abs(0)
             self.trivial = True
         else:
-            parsed = DataExpression.arith_expr.parseString(expr, parseAll=True)[0]
             self.trivial = False
-            # + 0 is to stop non-binary expressions breaking with sqlalchemy's label() -- bodge, fixme
-            expr = parsed.eval(self) + 0
+        parsed_expr = parsed_cond = None
+        if not self.trivial:
+            parsed_expr = DataExpression.arith_expr.parseString(expr, parseAll=True)[0]
+        if cond != '':
+            parsed_cond = DataExpression.cond_expr.parseString(cond, parseAll=True)[0]
+        self.shared = common_subexpressions([t for t in (parsed_expr, parsed_cond) if t is not None])
+        if parsed_expr is not None:
+            expr = parsed_expr.eval(self)
+            if not is_sql(expr):
+                # folded to a constant
+                expr = sqlalchemy.literal(expr)
+            if is_boolean(expr):
+                expr = number(expr)
+            else:
+                # + 0 is to stop non-binary expressions breaking with sqlalchemy's label() -- bodge, fixme
+                expr = expr + 0
+        self.value = expr
         query_attrs.append(sqlalchemy.sql.expression.label('q', expr))
         filter_expr = None
-        if cond != '':
-            parsed = DataExpression.cond_expr.parseString(cond, parseAll=True)[0]
-            filter_expr = parsed.eval(self)
+        if parsed_cond is not None:
+            filter_expr = parsed_cond.eval(self)
         self.query = eal.db.session.query(*query_attrs)
         if filter_expr is not None:
             self.query = self.query.filter(filter_expr)
-        for filter_expr in self.filters:
-            self.query = self.query.filter(filter_expr)
-        for tbl, join_l, join_r in self.joins:
-            self.query = self.query.join(tbl, join_l == join_r)
+        self.query = self.apply_joins(self.query, [filter_expr], [expr])
         if order_by_gid:
             self.query = self.query.order_by(gid_attr)
 
@@ -223,37 +590,27 @@ class DataExpression(object):
     def get_name(self):
         return self.name
 
-    def get_table_class(self, table_name):
-        if table_name not in self.table_instances:
-            self.table_instances[table_name] = eal.get_table_class(table_name)
-        return self.table_instances[table_name]
-
-    def lookup(self, attr_name):
-        attr_column_linkage, attr_column_info = eal.resolve_attribute(self.geometry_source, attr_name)
-        attr_tbl = self.get_table_class(attr_column_info.table_info.name)
-        attr_attr = getattr(attr_tbl, attr_column_info.name)
-        # and our join columns
-        attr_linkage = getattr(attr_tbl, attr_column_linkage.attr_column)
-        tbl_linkage = getattr(self.tbl, attr_column_linkage.geo_column)
-        self.joins.add((attr_tbl, attr_linkage, tbl_linkage))
-        return attr_attr
-
-    def add_filter(self, f):
-        self.filters.append(f)
-
     def get_query(self):
         return self.query
 
+    def bounds_column(self, envelope, srid):
+        """returns (geometry attribute, envelope) to compare @envelope (in @srid) against:
+        a geometry column in @srid if there is one, otherwise the projected column, with
+        the envelope transformed to suit"""
+        column = self.geometry_source.srid_column(srid)
+        if column is None:
+            proj_srid = int(eal.get_setting('projected_srid'))
+            column = self.geometry_source.srid_column(proj_srid)
+            envelope = sqlalchemy.func.st_transform(envelope, proj_srid)
+        return getattr(self.tbl, column), envelope
+
     def get_query_bounds(self, ne, sw, srid):
         ymin, xmin = sw
         ymax, xmax = ne
-        proj_srid = int(eal.get_setting('projected_srid'))
-        proj_column = self.geometry_source.srid_column(proj_srid)
-        q = self.query.filter(sqlalchemy.func.st_intersects(
-            sqlalchemy.func.st_transform(
-                sqlalchemy.func.st_makeenvelope(xmin, ymin, xmax, ymax, srid),
-                proj_srid),
-            getattr(self.tbl, proj_column)))
+        geom_attr, envelope = self.bounds_column(
+            sqlalchemy.func.st_makeenvelope(xmin, ymin, xmax, ymax, srid),
+            srid)
+        q = self.query.filter(sqlalchemy.func.st_intersects(envelope, geom_attr))
         return q
 
     def get_geometry_source(self):
@@ -263,7 +620,17 @@ class DataExpression(object):
         return printquery(self.query)
 
     def get_mapserver_query(self):
-        return ("%s from (%s) as subquery using unique %s using srid=%d" % (self.geometry_column, self.get_printed_query(), self.geometry_source.gid, self.srid)).replace("\n", "")
+        # MapServer replaces !BOX! with the extent being drawn (in our SRID); filtering inside
+        # the subquery means attribute joins only touch features within that extent, rather
+        # than relying upon Postgres to push MapServer's own filter down into the subquery
+        geom_attr, envelope = self.bounds_column(sqlalchemy.literal_column('!BOX!'), self.srid)
+        query = self.query.filter(geom_attr.op('&&')(envelope))
+        if not self.trivial:
+            # MapServer passes a NULL value to the class expressions as an empty string, which compares
+            # as 0; leave out features without a value, rather than fill them in the lowest colour
+            query = query.filter(self.value != None)  # noqa
+        query = printquery(query)
+        return ("%s from (%s) as subquery using unique %s using srid=%d" % (self.geometry_column, query, self.geometry_source.gid, self.srid)).replace("\n", "")
 
 
 if __name__ == '__main__':
@@ -12,10 +12,14 @@ from sqlalchemy.ext.declarative import declarative_base
 import sys
 import os
 import sqlalchemy
+from sqlalchemy.dialects import postgresql
 import pyparsing
 import hashlib
 import time
 import random
+import datetime
+import threading
+import metrics
 
 Base = declarative_base()
 
@@ -161,14 +165,22 @@ class EAlGIS(object):
             return info
 
         if self.datainfo is None:
+            metrics.inc('ealgis_cache_total', cache='datainfo', result='miss')
             self.datainfo = make_datainfo()
+        else:
+            metrics.inc('ealgis_cache_total', cache='datainfo', result='hit')
         return self.datainfo
 
     def serve(self):
         self.cache = {}
         print "%d >> spinning up" % (os.getpid())
-        # prime datainfo
+        metrics.instrument_engine(self.db.engine)
+        # prime datainfo; if uWSGI forks workers after loading the application,
+        # they all share this copy
         self.get_datainfo()
+        # don't share database connections with forked workers
+        self.db.session.remove()
+        self.db.engine.dispose()
         print "%d >> ready" % (os.getpid())
         return self.app
 
@@ -230,7 +242,25 @@ class EAlGIS(object):
             return False
 
     def get_table(self, table_name):
-        return sqlalchemy.Table(table_name, sqlalchemy.MetaData(), autoload=True, autoload_with=db.engine)
+        "the table @table_name; for a table split into column groups, a join of the tables holding them"
+        groups = self.column_group_tables(table_name)
+        if not groups:
+            return sqlalchemy.Table(table_name, sqlalchemy.MetaData(), autoload=True, autoload_with=db.engine)
+        metadata = sqlalchemy.MetaData()
+        tables = [sqlalchemy.Table(t, metadata, autoload=True, autoload_with=db.engine) for t in groups]
+        # each group has the primary key, and the rest of the columns are in exactly one group
+        pkey = [t.name for t in tables[0].primary_key]
+        columns = list(tables[0].c)
+        joined = tables[0]
+        for tbl in tables[1:]:
+            columns += [t for t in tbl.c if t.name not in pkey]
+            joined = joined.join(tbl, sqlalchemy.and_(*[tables[0].c[t] == tbl.c[t] for t in pkey]))
+        return sqlalchemy.select(columns).select_from(joined).alias(table_name)
+
+    def column_group_tables(self, table_name):
+        "names of the tables holding the column groups of @table_name; empty if it isn't split"
+        return sorted(set(t for (t, ) in self.db.session.query(ColumnStorage.table_name).join(TableInfo).filter(
+            TableInfo.name == table_name)))
 
     def get_table_names(self):
         "get a list of the table names in a database. NB: this is *expensive memory wise* on a complex DB"
@@ -248,8 +278,9 @@ class EAlGIS(object):
             print >>sys.stderr, "table `%s' is not registered with EAlGIS, unload request ignored." % table_name
             return False
         try:
-            tbl = self.get_table(table_name)
-            tbl.drop(self.db.engine)
+            for physical_name in self.physical_tables(ti):
+                tbl = self.get_table(physical_name)
+                tbl.drop(self.db.engine)
             self.db.session.delete(ti)
             self.db.session.commit()
             return True
@@ -287,16 +318,89 @@ class EAlGIS(object):
         ti.metadata_json = json.dumps(meta_dict)
         self.db.session.commit()
 
-    def register_columns(self, table_name, columns):
+    def register_columns(self, table_name, columns, statistics=True):
         ti = self.get_table_info(table_name)
         for column_name, meta_dict in columns:
             ci = ColumnInfo(name=column_name, table_info=ti, metadata_json=json.dumps(meta_dict))
             self.db.session.add(ci)
         self.db.session.commit()
+        if statistics:
+            self.compute_column_statistics(table_name, [t[0] for t in columns])
+
+    def compute_column_statistics(self, table_name, column_names=None):
+        """compute, and store in the catalog, statistics of the columns of a registered table
+        (by default, all of them); min, max and quantiles are only computed for numeric columns"""
+        ti = self.get_table_info(table_name)
+        column_infos = ti.column_info.all()
+        if column_names is not None:
+            column_names = set(column_names)
+            column_infos = [t for t in column_infos if t.name in column_names]
+        by_table = {}
+        for ci in column_infos:
+            by_table.setdefault(self.column_table(ci), []).append(ci)
+        fractions = [float(t) for t in ColumnStatistics.quantile_fractions]
+        for physical_name, table_column_infos in sorted(by_table.items()):
+            tbl = self.get_table(physical_name)
+            # planner statistics give us an estimate of the number of distinct values
+            self.db.session.execute('ANALYZE %s' % (physical_name))
+            n_distinct = dict(self.db.session.execute(
+                sqlalchemy.text("SELECT attname, n_distinct FROM pg_stats WHERE schemaname=current_schema() AND tablename=:t"),
+                {'t': physical_name}).fetchall())
+            table_column_infos = [t for t in table_column_infos if t.name in tbl.c]
+            # a query for a batch of columns, scanning the table once
+            for i in xrange(0, len(table_column_infos), 32):
+                batch = table_column_infos[i:i + 32]
+                aggregates = [sqlalchemy.func.count()]
+                for ci in batch:
+                    column = tbl.c[ci.name]
+                    aggregates.append(sqlalchemy.func.count(column))
+                    if isinstance(column.type, (sqlalchemy.types.Integer, sqlalchemy.types.Numeric)):
+                        aggregates += [
+                            sqlalchemy.func.min(column),
+                            sqlalchemy.func.max(column),
+                            sqlalchemy.func.percentile_cont(postgresql.array(fractions)).within_group(column)]
+                row = list(self.db.session.execute(sqlalchemy.select(aggregates)).fetchone())
+                row_count = row.pop(0)
+                for ci in batch:
+                    count = row.pop(0)
+                    stats = ColumnStatistics(
+                        row_count=row_count,
+                        null_count=row_count - count)
+                    distinct = n_distinct.get(ci.name)
+                    if distinct is not None:
+                        # negative values are a multiple of the number of rows
+                        stats.distinct_estimate = distinct if distinct >= 0 else -distinct * row_count
+                    if isinstance(tbl.c[ci.name].type, (sqlalchemy.types.Integer, sqlalchemy.types.Numeric)):
+                        vmin, vmax, quantiles = row.pop(0), row.pop(0), row.pop(0)
+                        stats.min = float(vmin) if vmin is not None else None
+                        stats.max = float(vmax) if vmax is not None else None
+                        if quantiles is not None and count > 0:
+                            stats.quantiles = json.dumps(zip(fractions, quantiles))
+                    ci.statistics = stats
+            self.db.session.commit()
 
     def register_column(self, table_name, column_name, meta_dict):
         self.register_columns(table_name, [column_name, meta_dict])
 
+    def register_column_storage(self, table_name, columns):
+        "record that the columns of a (wide) table are stored in other physical tables; @columns is [(column_name, physical_table_name), ...]"
+        ti = self.get_table_info(table_name)
+        for column_name, physical_name in columns:
+            self.db.session.add(ColumnStorage(name=column_name, table_info=ti, table_name=physical_name))
+        self.db.session.commit()
+
+    def physical_tables(self, table_info):
+        "names of the database tables holding the data for a registered table"
+        names = sorted(set(t for (t, ) in table_info.column_storage.with_entities(ColumnStorage.table_name)))
+        return names or [table_info.name]
+
+    def column_table(self, column_info):
+        "name of the database table holding a column"
+        try:
+            return column_info.table_info.column_storage.filter(ColumnStorage.name == column_info.name).one().table_name
+        except sqlalchemy.orm.exc.NoResultFound:
+            return column_info.table_info.name
+
     def required_srids(self):
         srids = set()
 
@@ -356,6 +460,66 @@ class EAlGIS(object):
             new_column))
         self.db.session.commit()
 
+    def prepare_geometry(self, geometry_source, to_srids):
+        """repair invalid geometry, and add a reprojected column for each of @to_srids;
+        the new columns are filled in a single pass. returns the names of the new columns"""
+        table_name = geometry_source.table_info.name
+        # only the invalid rows are rewritten, so each geometry is validated once
+        self.repair_geometry(geometry_source)
+        if not to_srids:
+            return []
+        print "running geometry reprojection:", table_name
+        new_columns = []
+        for to_srid in sorted(to_srids):
+            new_column = "%s_%d" % (geometry_source.column, to_srid)
+            self.db.session.execute(sqlalchemy.func.addgeometrycolumn(
+                table_name,
+                new_column,
+                to_srid,
+                geometry_source.geometry_type,
+                2))  # fixme ndim=2 shouldn't be hard-coded
+            new_columns.append((to_srid, new_column))
+        # one pass over the table for all of the projections
+        assignments = []
+        for to_srid, new_column in new_columns:
+            assignments.append('%s = st_transform(st_force2d(%s), %d)' % (new_column, geometry_source.column, to_srid))
+        self.db.session.execute("UPDATE %s SET %s" % (table_name, ', '.join(assignments)))
+        for to_srid, new_column in new_columns:
+            self.db.session.add(GeometrySourceProjected(
+                geometry_source=geometry_source,
+                srid=to_srid,
+                column=new_column))
+        return [new_column for (_, new_column) in new_columns]
+
+    def create_geometry_indexes(self, table_name, columns):
+        "build a GiST index on each of @columns; each index is built in its own database session, in parallel"
+        errors = []
+
+        def build(column):
+            start = time.time()
+            conn = self.db.engine.connect()
+            try:
+                conn.execute("CREATE INDEX %s ON %s USING gist ( %s )" % (
+                    "%s_%s_gist" % (table_name, column),
+                    table_name,
+                    column))
+                print "... built index on %s.%s (%.1fs)" % (table_name, column, time.time() - start)
+            except Exception as e:
+                # an exception can't escape a thread; it's raised once they've all finished
+                print >>sys.stderr, "... failed to build index on %s.%s: %s" % (table_name, column, e)
+                errors.append(e)
+            finally:
+                conn.close()
+
+        print "building %d geometry index(es) on %s" % (len(columns), table_name)
+        threads = [threading.Thread(target=build, args=(column, )) for column in columns]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
     def register_table(self, table_name, geom=False, srid=None, gid=None):
         self.metadata_dirty()
         ti = TableInfo(name=table_name)
@@ -378,9 +542,13 @@ class EAlGIS(object):
             to_generate = self.required_srids()
             if srid in to_generate:
                 to_generate.remove(srid)
-            self.repair_geometry(ti.geometry_source)
-            for gen_srid in to_generate:
-                self.reproject(ti.geometry_source, gen_srid)
+            new_columns = self.prepare_geometry(ti.geometry_source, to_generate)
+            # committed, so that the new columns are visible to the sessions building indexes
+            self.db.session.commit()
+            # the loader may have left indexing the geometry until now, after it has been repaired
+            if not self.column_indexed(table_name, column.name):
+                new_columns.insert(0, column.name)
+            self.create_geometry_indexes(table_name, new_columns)
         self.db.session.commit()
         return ti
 
@@ -393,6 +561,7 @@ class EAlGIS(object):
     def get_geometry_source_by_id(self, id):
         return GeometrySource.query.filter(GeometrySource.id == id).one()
 
+    @metrics.timed('resolve_attribute')
     def resolve_attribute(self, geometry_source, attribute):
         attribute = attribute.lower()  # upper case tables or columns seem unlikely, but a possible FIXME
         # supports table_name.column_name OR just column_name
@@ -423,6 +592,118 @@ class EAlGIS(object):
             attr_column=attr_column)
         self.db.session.add(linkage)
         self.db.session.commit()
+        self.index_linkage(linkage)
+
+    def column_index_name(self, table_name, column_name):
+        "name of a valid index on @table_name with @column_name as its leading column, or None"
+        q = sqlalchemy.text("""
+            SELECT CAST(pg_index.indexrelid AS regclass) FROM pg_index
+            JOIN pg_attribute ON pg_attribute.attrelid = pg_index.indrelid AND pg_attribute.attnum = pg_index.indkey[0]
+            WHERE pg_index.indrelid = CAST(:table_name AS regclass) AND pg_attribute.attname = :column_name AND pg_index.indisvalid
+            LIMIT 1""")
+        return self.db.session.execute(q, {'table_name': table_name, 'column_name': column_name}).scalar()
+
+    def column_indexed(self, table_name, column_name):
+        "is there an index on @table_name with @column_name as its leading column?"
+        return self.column_index_name(table_name, column_name) is not None
+
+    def ensure_index(self, table_name, column_name):
+        "create a btree index on a column if there isn't one already; returns True if an index was created"
+        if self.column_indexed(table_name, column_name):
+            return False
+        index_name = "%s_%s_idx" % (table_name, column_name)
+        # a failed or interrupted concurrent build leaves behind an invalid index, which
+        # has to be dropped before the index can be built again under the same name
+        invalid = self.db.session.execute(
+            sqlalchemy.text("SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:index_name)"),
+            {'index_name': index_name}).scalar()
+        # building an index concurrently waits for open transactions, including ours
+        self.db.session.commit()
+        conn = self.db.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+        try:
+            if invalid:
+                conn.execute("DROP INDEX CONCURRENTLY IF EXISTS %s" % (index_name))
+            conn.execute("CREATE INDEX CONCURRENTLY %s ON %s ( %s )" % (
+                index_name,
+                table_name,
+                column_name))
+            conn.execute("ANALYZE %s" % (table_name))
+        finally:
+            conn.close()
+        return True
+
+    def table_size(self, table_name):
+        "on-disk size of a table, including its indexes and TOAST data, in bytes"
+        return self.db.session.execute(
+            sqlalchemy.text("SELECT pg_total_relation_size(CAST(:table_name AS regclass))"),
+            {'table_name': table_name}).scalar()
+
+    def optimise_table(self, table_name, cluster_column=None):
+        """physically reorder a table by the index on @cluster_column (if given, and indexed), and
+        then VACUUM ANALYZE it. returns the size of the table before and after, in bytes"""
+        before = self.table_size(table_name)
+        index_name = None
+        if cluster_column is not None:
+            index_name = self.column_index_name(table_name, cluster_column)
+        self.db.session.commit()
+        conn = self.db.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+        try:
+            if index_name is not None:
+                conn.execute("CLUSTER %s USING %s" % (table_name, index_name))
+            conn.execute("VACUUM ANALYZE %s" % (table_name))
+        finally:
+            conn.close()
+        return before, self.table_size(table_name)
+
+    def optimise(self, table_names=None):
+        """reorder and vacuum registered tables: geometry tables are clustered on the spatial index of
+        their projected geometry, attribute tables on the index of their linkage column.
+        returns [(table name, size before, size after), ...]"""
+        proj_srid = int(self.get_setting('projected_srid', 0)) or None
+        to_optimise = []
+        for ti in TableInfo.query.order_by(TableInfo.name).all():
+            if table_names is not None and ti.name not in table_names:
+                continue
+            source = ti.geometry_source
+            if source is not None:
+                column = source.srid_column(proj_srid) or source.column
+                if not self.column_indexed(ti.name, column):
+                    self.create_geometry_indexes(ti.name, [column])
+                to_optimise.append((ti.name, column))
+                continue
+            linkage = ti.linkages.first()
+            for table_name in self.physical_tables(ti):
+                to_optimise.append((table_name, linkage.attr_column if linkage is not None else None))
+        results = []
+        for table_name, column in to_optimise:
+            before, after = self.optimise_table(table_name, column)
+            print "%s: %.1fMB -> %.1fMB" % (table_name, before / 1048576., after / 1048576.)
+            results.append((table_name, before, after))
+        return results
+
+    def linkage_columns(self, linkage):
+        "the (table name, column name) pairs joined by a linkage"
+        columns = [(linkage.geometry_source.table_info.name, linkage.geo_column)]
+        for table_name in self.physical_tables(linkage.attribute_table):
+            columns.append((table_name, linkage.attr_column))
+        return columns
+
+    def index_linkage(self, linkage):
+        "make sure the columns on both sides of a linkage are indexed; returns the (table, column) pairs indexed"
+        created = []
+        for table_name, column_name in self.linkage_columns(linkage):
+            if self.ensure_index(table_name, column_name):
+                print "indexed linkage column: %s.%s" % (table_name, column_name)
+                created.append((table_name, column_name))
+        return created
+
+    def linkage_index_coverage(self):
+        "returns [(linkage, table name, column name, indexed), ...] for every linkage"
+        coverage = []
+        for linkage in GeometryLinkage.query.order_by(GeometryLinkage.id).all():
+            for table_name, column_name in self.linkage_columns(linkage):
+                coverage.append((linkage, table_name, column_name, self.column_indexed(table_name, column_name)))
+        return coverage
 
     def get_geometry_relation(self, from_source, to_source):
         try:
@@ -499,6 +780,11 @@ class TableInfo(db.Model):
         backref=db.backref('attribute_table'),
         cascade="all",
         lazy='dynamic')
+    column_storage = db.relationship(
+        'ColumnStorage',
+        backref=db.backref('table_info'),
+        cascade="all",
+        lazy='dynamic')
     metadata_json = db.Column(db.String(2048))
 
 
@@ -508,6 +794,47 @@ class ColumnInfo(db.Model):
     name = db.Column(db.String(256), index=True)
     tableinfo_id = db.Column(db.Integer, db.ForeignKey('table_info.id'), index=True, nullable=False)
     metadata_json = db.Column(db.String(2048))
+    statistics = db.relationship(
+        'ColumnStatistics',
+        backref=db.backref('column_info'),
+        cascade="all, delete-orphan",
+        uselist=False)
+    __table_args__ = (db.UniqueConstraint('name', 'tableinfo_id'), )
+
+
+class ColumnStatistics(db.Model):
+    "statistics of the values in a column, computed when it is registered"
+    quantile_fractions = (0.01, 0.05, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99)
+    id = db.Column(db.Integer, primary_key=True)
+    columninfo_id = db.Column(db.Integer, db.ForeignKey('column_info.id'), unique=True, index=True, nullable=False)
+    row_count = db.Column(db.Integer, nullable=False)
+    null_count = db.Column(db.Integer, nullable=False)
+    # from the planner's statistics; based on a sample of the table
+    distinct_estimate = db.Column(db.Float)
+    # min, max and quantiles are only computed for numeric columns
+    min = db.Column(db.Float)
+    max = db.Column(db.Float)
+    # JSON: [[fraction, value], ...]
+    quantiles = db.Column(db.Text())
+    computed = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    def get(self):
+        return {
+            'row_count': self.row_count,
+            'null_count': self.null_count,
+            'distinct_estimate': self.distinct_estimate,
+            'min': self.min,
+            'max': self.max,
+            'quantiles': json.loads(self.quantiles) if self.quantiles is not None else None,
+        }
+
+
+class ColumnStorage(db.Model):
+    "for wide tables split into column groups: the physical table holding each column"
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(256), nullable=False)
+    tableinfo_id = db.Column(db.Integer, db.ForeignKey('table_info.id'), index=True, nullable=False)
+    table_name = db.Column(db.String(256), nullable=False)
     __table_args__ = (db.UniqueConstraint('name', 'tableinfo_id'), )
 
 
@@ -625,7 +952,7 @@ class GeometryRelation(db.Model):
         sqlalchemy.Index('georelation_lookup', geo_source_id, overlaps_with_id))
 
 # mapserver epoch; allows us to force re-compilation when things are changed
-MAPSERVER_EPOCH = 2
+MAPSERVER_EPOCH = 7
 
 
 class MapDefinition(db.Model):
@@ -635,6 +962,11 @@ class MapDefinition(db.Model):
     name = db.Column(db.String(32), nullable=False, index=True)
     description = db.Column(db.Text())
     json = db.Column(db.Text())
+    query_plans = db.relationship(
+        'QueryPlan',
+        backref=db.backref('map_definition'),
+        cascade="all",
+        lazy='dynamic')
 
     @classmethod
     def get_by_name(self, map_name):
@@ -737,3 +1069,19 @@ class MapDefinition(db.Model):
             return self._set(defn, **kwargs)
         except pyparsing.ParseException as e:
             raise CompilationError(str(e))
+
+
+class QueryPlan(db.Model):
+    "EXPLAIN (ANALYZE, BUFFERS) output for the tile query of a map layer"
+    id = db.Column(db.Integer, primary_key=True)
+    map_definition_id = db.Column(db.Integer, db.ForeignKey('map_definition.id'), index=True, nullable=False)
+    layer_id = db.Column(db.String(32), nullable=False)
+    layer_hash = db.Column(db.String(32))
+    # minx,miny,maxx,maxy in the map SRID
+    bbox = db.Column(db.String(256), nullable=False)
+    # milliseconds
+    duration = db.Column(db.Float)
+    # captured automatically, rather than on request
+    sampled = db.Column(db.Boolean, nullable=False, default=False)
+    created = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    plan = db.Column(db.Text(), nullable=False)
@@ -9,7 +9,7 @@ import os
 import csv
 import sys
 import email
-from db import EAlGIS, User
+import json
 
 
 def main():
@@ -119,9 +119,56 @@ def main():
                 os.mkdir(tmpdir)
             except OSError:
                 pass
-            loader.go(eal, tmpdir, **opts_module)
+            if hasattr(loader, 'plan'):
+                # loader submits independent tasks, which we may run in parallel
+                from loaders import LoadRunner
+                runner = LoadRunner(eal, jobs=args.jobs)
+                loader.plan(eal, tmpdir, runner, **opts_module)
+                runner.run()
+            else:
+                loader.go(eal, tmpdir, **opts_module)
             del loader
 
+    def explain(args):
+        EAlGIS()
+        from db import MapDefinition
+        from explain import explain_layer, format_plan
+        defn_obj = MapDefinition.get_by_name(args.map_name)
+        if defn_obj is None:
+            print >>sys.stderr, "no such map: %s" % (args.map_name)
+            sys.exit(1)
+        bbox = None
+        if args.bbox is not None:
+            bbox = map(float, args.bbox.split(','))
+        query_plan = explain_layer(defn_obj, args.layer_id, bbox=bbox, store=not args.no_store)
+        print "bbox: %s" % (query_plan.bbox)
+        print format_plan(json.loads(query_plan.plan))
+
+    def index_linkages(args):
+        eal = EAlGIS()
+        if not args.report:
+            from db import GeometryLinkage
+            for linkage in GeometryLinkage.query.order_by(GeometryLinkage.id).all():
+                eal.index_linkage(linkage)
+        coverage = eal.linkage_index_coverage()
+        w = csv.writer(sys.stdout)
+        w.writerow(['linkage', 'table', 'column', 'indexed'])
+        for linkage, table_name, column_name, indexed in coverage:
+            w.writerow([linkage.id, table_name, column_name, indexed])
+        print >>sys.stderr, "%d of %d linkage columns indexed" % (len([t for t in coverage if t[3]]), len(coverage))
+
+    def optimise(args):
+        eal = EAlGIS()
+        results = eal.optimise(args.table_name or None)
+        reclaimed = sum(before - after for (_, before, after) in results)
+        print "%d tables optimised, %.1fMB reclaimed" % (len(results), reclaimed / 1048576.)
+
+    def column_stats(args):
+        eal = EAlGIS()
+        for table_name in args.table_name:
+            print "computing column statistics:", table_name
+            eal.compute_column_statistics(table_name)
+
     def recompile(args):
         eal = EAlGIS()
         eal.recompile_all()
@@ -144,6 +191,7 @@ def main():
     parser_run = subparsers.add_parser('run', help='Run data loader')
     parser_run.add_argument('module', type=str, nargs='+', help='Path to loader module')
     parser_run.add_argument('--opts', '-o', help='loader options')
+    parser_run.add_argument('--jobs', '-j', type=int, default=1, help='number of load tasks to run in parallel')
     parser_run.set_defaults(func=run)
 
     parser_listusers = subparsers.add_parser('listusers', help="List users")
@@ -171,10 +219,33 @@ def main():
     parser_georelate.add_argument('geom_right', type=str, help="Right geometry")
     parser_georelate.set_defaults(func=georelate)
 
+    parser_explain = subparsers.add_parser('explain', help="EXPLAIN ANALYZE the tile query of a map layer")
+    parser_explain.add_argument('map_name', type=str)
+    parser_explain.add_argument('layer_id', type=str)
+    parser_explain.add_argument('--bbox', type=str, help="minx,miny,maxx,maxy in the map SRID (default: around a representative feature)")
+    parser_explain.add_argument('--no-store', action='store_true', help="don't save the plan to the database")
+    parser_explain.set_defaults(func=explain)
+
+    parser_indexlinkages = subparsers.add_parser('indexlinkages', help="Index the join columns of geometry linkages")
+    parser_indexlinkages.add_argument('--report', action='store_true', help="only report index coverage")
+    parser_indexlinkages.set_defaults(func=index_linkages)
+
+    parser_optimise = subparsers.add_parser('optimise', help="Reorder and vacuum loaded tables")
+    parser_optimise.add_argument('table_name', type=str, nargs='*', help="tables to optimise (default: all)")
+    parser_optimise.set_defaults(func=optimise)
+
+    parser_columnstats = subparsers.add_parser('columnstats', help="Compute catalog statistics for the columns of tables")
+    parser_columnstats.add_argument('table_name', type=str, nargs='+', help="tables to compute statistics for")
+    parser_columnstats.set_defaults(func=column_stats)
+
     parser_recompile = subparsers.add_parser('recompile', help="Recompile cached SQL queries")
     parser_recompile.set_defaults(func=recompile)
 
     args = parser.parse_args()
+    # importing db sets up the application (and pulls in Flask and SQLAlchemy), so it's
+    # left until we know there's something to do; the commands above find these names
+    # here, when they're called
+    from db import EAlGIS, User
     if args.verbose:
         EAlGIS().db.engine.echo = True
     args.func(args)
@@ -1,10 +1,38 @@
 #!/usr/bin/env python
 
 # top-level for uwsgi
-from db import EAlGIS
+import time
+import os
+start = time.time()
 
-eal = EAlGIS()
-app = eal.serve().wsgi_app
+from db import EAlGIS  # noqa
+import metrics  # noqa
+
+# time taken by each phase of startup, reported once we're ready
+timings = [('imports', time.time() - start)]
+
+
+def startup_phase(name, fn):
+    phase_start = time.time()
+    rv = fn()
+    elapsed = time.time() - phase_start
+    timings.append((name, elapsed))
+    metrics.observe('ealgis_phase_seconds', elapsed, phase='startup_' + name)
+    return rv
+
+eal = startup_phase('app', EAlGIS)
+app = startup_phase('serve', eal.serve).wsgi_app
 
 # load in URL handlers
+handlers_start = time.time()
 import handlers  # noqa
+timings.append(('handlers', time.time() - handlers_start))
+metrics.observe('ealgis_phase_seconds', timings[-1][1], phase='startup_handlers')
+# startup happens once, in the uWSGI master; workers forked from it start
+# with no metrics, so write out the master's own
+metrics.registry.write(force=True)
+
+print "%d >> started in %.2fs (%s)" % (
+    os.getpid(),
+    time.time() - start,
+    ', '.join('%s %.2fs' % t for t in timings))
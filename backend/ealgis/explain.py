@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+#
+# capture EXPLAIN (ANALYZE, BUFFERS) plans for the queries MapServer runs
+# to draw a layer's tiles
+#
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+import threading
+import random
+import Queue
+import sys
+import os
+import psycopg2
+import sqlalchemy
+from db import EAlGIS, MapDefinition, QueryPlan
+
+# defaults for tile query sampling; may be overridden by the `slow_query_ms'
+# and `slow_query_sample_rate' settings (read once per process)
+slow_query_ms = 2000.
+slow_query_sample_rate = 0.1
+_sampling = None
+# slow tiles are explained by a thread of their own, so the request which drew
+# the tile isn't held up; if it falls behind, further samples are dropped
+_samples = None
+_sampler_pid = None
+
+
+def mapserver_tile_sql(expr, bbox):
+    "SQL equivalent to that MapServer runs to draw a tile covering @bbox (in the layer SRID)"
+    envelope = "ST_MakeEnvelope(%r, %r, %r, %r, %d)" % (bbox[0], bbox[1], bbox[2], bbox[3], expr.srid)
+    # as MapServer does, substitute the extent for !BOX! in the layer's query
+    data = expr.get_mapserver_query()
+    subquery = data[data.index('(') + 1:data.rindex(') as subquery')]
+    return "SELECT * FROM (%s) AS subquery" % (subquery.replace('!BOX!', envelope))
+
+
+def representative_bbox(expr):
+    "a bounding box (in the layer SRID) around a feature from the middle of the layer's geometry source"
+    eal = EAlGIS()
+    geom_attr = getattr(expr.tbl, expr.geometry_column)
+    gid_attr = getattr(expr.tbl, expr.geometry_source.gid)
+    count = eal.db.session.query(sqlalchemy.func.count(gid_attr)).scalar()
+    xmin, ymin, xmax, ymax = eal.db.session.query(
+        sqlalchemy.func.st_xmin(geom_attr),
+        sqlalchemy.func.st_ymin(geom_attr),
+        sqlalchemy.func.st_xmax(geom_attr),
+        sqlalchemy.func.st_ymax(geom_attr)).filter(geom_attr != None).order_by(gid_attr).offset(count // 2).limit(1).one()  # noqa
+    # take in some of the surrounding features
+    dx, dy = xmax - xmin, ymax - ymin
+    return (xmin - dx, ymin - dy, xmax + dx, ymax + dy)
+
+
+def plan_duration(plan):
+    "execution time, in milliseconds, of a JSON format plan"
+    top = plan[0]
+    return top.get('Execution Time', top.get('Total Runtime'))
+
+
+def format_plan(plan):
+    "render a JSON format plan as indented text"
+    lines = []
+
+    def walk(node, depth):
+        desc = node['Node Type']
+        if 'Relation Name' in node:
+            desc += ' on %s' % (node['Relation Name'])
+        if 'Index Name' in node:
+            desc += ' using %s' % (node['Index Name'])
+        lines.append('%s%s  (actual time=%.3f..%.3f rows=%d loops=%d; shared hit=%d read=%d)' % (
+            '  ' * depth,
+            desc,
+            node.get('Actual Startup Time', 0),
+            node.get('Actual Total Time', 0),
+            node.get('Actual Rows', 0),
+            node.get('Actual Loops', 0),
+            node.get('Shared Hit Blocks', 0),
+            node.get('Shared Read Blocks', 0)))
+        for child in node.get('Plans', []):
+            walk(child, depth + 1)
+
+    walk(plan[0]['Plan'], 0)
+    lines.append('Execution time: %.3f ms' % (plan_duration(plan)))
+    return '\n'.join(lines)
+
+
+def explain_layer(defn_obj, layer_id, bbox=None, store=True, sampled=False):
+    """run EXPLAIN (ANALYZE, BUFFERS) on the tile query for a layer of a map, over @bbox
+    (in the map SRID); if no bbox is given, a representative one is chosen.
+    returns the QueryPlan, which is saved to the database if @store is set"""
+    eal = EAlGIS()
+    layer = defn_obj.get()['layers'][layer_id]
+    expr = defn_obj.compile_expr(layer)
+    if bbox is None:
+        bbox = representative_bbox(expr)
+    cursor = eal.db.session.connection().connection.cursor()
+    cursor.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + mapserver_tile_sql(expr, bbox))
+    plan = cursor.fetchone()[0]
+    cursor.close()
+    if not isinstance(plan, list):
+        plan = json.loads(plan)
+    query_plan = QueryPlan(
+        map_definition_id=defn_obj.id,
+        layer_id=layer_id,
+        layer_hash=layer.get('hash'),
+        bbox=','.join(repr(t) for t in bbox),
+        duration=plan_duration(plan),
+        sampled=sampled,
+        plan=json.dumps(plan))
+    if store:
+        eal.db.session.add(query_plan)
+        eal.db.session.commit()
+    return query_plan
+
+
+def capture_sample(map_name, layer_id, bbox, elapsed):
+    defn_obj = MapDefinition.get_by_name(map_name)
+    if defn_obj is None:
+        return
+    try:
+        query_plan = explain_layer(defn_obj, layer_id, bbox=bbox, sampled=True)
+        print >>sys.stderr, "slow tile (%.0fms) for %s/%s; plan captured, query took %.0fms" % (
+            elapsed * 1000., map_name, layer_id, query_plan.duration)
+    except (sqlalchemy.exc.SQLAlchemyError, psycopg2.Error) as e:
+        EAlGIS().db.session.rollback()
+        print >>sys.stderr, "unable to capture plan for slow tile: %s" % (e)
+
+
+def sampler(samples):
+    eal = EAlGIS()
+    while True:
+        args = samples.get()
+        with eal.app.app_context():
+            try:
+                capture_sample(*args)
+            finally:
+                eal.db.session.remove()
+
+
+def sample_slow_tile(map_name, layer_id, bbox, elapsed):
+    """called after a tile has been drawn, taking @elapsed seconds; if the tile was slow,
+    a proportion of the time the plan for its query is captured, in the background"""
+    global _sampling, _samples, _sampler_pid
+    if _sampling is None:
+        eal = EAlGIS()
+        _sampling = (
+            float(eal.get_setting('slow_query_ms', slow_query_ms)),
+            float(eal.get_setting('slow_query_sample_rate', slow_query_sample_rate)))
+    threshold_ms, rate = _sampling
+    if elapsed * 1000. < threshold_ms or random.random() >= rate:
+        return
+    # threads don't survive a fork, so each uWSGI worker starts its own
+    if _sampler_pid != os.getpid():
+        _sampler_pid = os.getpid()
+        _samples = Queue.Queue(maxsize=8)
+        thread = threading.Thread(target=sampler, args=(_samples, ))
+        thread.daemon = True
+        thread.start()
+    try:
+        _samples.put_nowait((map_name, layer_id, bbox, elapsed))
+    except Queue.Full:
+        pass
+
+
+if __name__ == '__main__':
+    defn_obj = MapDefinition.get_by_name(sys.argv[1])
+    query_plan = explain_layer(defn_obj, sys.argv[2], store=False)
+    print format_plan(json.loads(query_plan.plan))
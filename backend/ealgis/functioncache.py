@@ -1,27 +1,208 @@
 
+#
+# persistent cache of function results, shared between processes
+#
+# results are pickled into a SQLite database; entries may expire after a
+# time-to-live, and the least recently used entries are evicted once the
+# cache grows beyond a set number of entries. to keep reads and writes
+# cheap, the time an entry was last used is only updated now and then, and
+# the cache is only checked for entries to evict every so many writes
+#
+
 from hashlib import sha1
-import os.path
+import unittest
+import tempfile
+import sqlite3
 import pickle
-import urllib
+import shutil
+import time
+import os
 
 cache_path = './cache/'
 
 
-def cache_result(fn):
-    def _wrapped(*args, **kwargs):
-        arg_hash = sha1()
-        arg_hash.update(pickle.dumps(args))
-        arg_hash.update(pickle.dumps(kwargs))
-        cache_file = os.path.join(cache_path, urllib.quote(fn.__name__) + '.' + arg_hash.hexdigest())
+class FunctionCache(object):
+    def __init__(self, path, max_entries=100000, touch_interval=600, evict_interval=100):
+        self.path = path
+        self.max_entries = max_entries
+        # seconds before a hit updates the time an entry was last used
+        self.touch_interval = touch_interval
+        # writes (by this process) between checks for entries to evict
+        self.evict_interval = evict_interval
+        self._puts = 0
+        self._pid = None
+        self._conn = None
+
+    def connection(self):
+        # connections can't be shared with forked processes
+        if self._conn is None or self._pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            # writers wait on each other's locks for up to the timeout
+            self._conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS result '
+                '(key TEXT PRIMARY KEY, fn TEXT, expires REAL, used REAL, value BLOB)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS result_used ON result (used)')
+            self._pid = os.getpid()
+            self._puts = 0
+        return self._conn
+
+    @classmethod
+    def key(cls, fn_name, args, kwargs):
+        return sha1(pickle.dumps((fn_name, args, sorted(kwargs.items())), pickle.HIGHEST_PROTOCOL)).hexdigest()
+
+    def get(self, key):
+        "returns (True, value) if @key is cached and hasn't expired, otherwise (False, None)"
+        now = time.time()
+        conn = self.connection()
+        row = conn.execute('SELECT expires, used, value FROM result WHERE key=?', (key, )).fetchone()
+        if row is None:
+            return False, None
+        expires, used, value = row
+        if expires is not None and expires < now:
+            return False, None
+        if used < now - self.touch_interval:
+            conn.execute('UPDATE result SET used=? WHERE key=?', (now, key))
+        return True, pickle.loads(str(value))
+
+    def put(self, key, fn_name, value, ttl=None):
+        now = time.time()
+        expires = now + ttl if ttl is not None else None
+        conn = self.connection()
+        conn.execute(
+            'INSERT OR REPLACE INTO result (key, fn, expires, used, value) VALUES (?, ?, ?, ?, ?)',
+            (key, fn_name, expires, now, sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))))
+        self._puts += 1
+        if self._puts >= self.evict_interval:
+            self._puts = 0
+            self.evict()
+
+    def evict(self):
+        "remove expired entries, then the least recently used entries beyond `max_entries'"
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
         try:
-            with open(cache_file, 'rb') as fd:
-                c_args, c_kwargs, rv = pickle.load(fd)
-                assert(c_args == args)
-                assert(c_kwargs == kwargs)
-                return rv
-        except IOError:
-            rv = fn(*args, **kwargs)
-            with open(cache_file, 'wb') as fd:
-                pickle.dump((args, kwargs, rv), fd)
+            conn.execute('DELETE FROM result WHERE expires < ?', (time.time(), ))
+            count, = conn.execute('SELECT COUNT(*) FROM result').fetchone()
+            if count > self.max_entries:
+                conn.execute(
+                    'DELETE FROM result WHERE key IN (SELECT key FROM result ORDER BY used LIMIT ?)',
+                    (count - self.max_entries, ))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def clear(self, fn_name=None):
+        if fn_name is None:
+            self.connection().execute('DELETE FROM result')
+        else:
+            self.connection().execute('DELETE FROM result WHERE fn=?', (fn_name, ))
+
+default_cache = FunctionCache(os.path.join(cache_path, 'functioncache.sqlite'))
+
+
+def cached(ttl=None, cache=None, cache_if=None):
+    """decorator; cache results of the function, for @ttl seconds (default: forever).
+    if @cache_if is given, only results for which it returns True are cached"""
+    def _decorator(fn):
+        def _wrapped(*args, **kwargs):
+            use_cache = cache or default_cache
+            key = FunctionCache.key(fn.__name__, args, kwargs)
+            hit, rv = use_cache.get(key)
+            if not hit:
+                rv = fn(*args, **kwargs)
+                if cache_if is None or cache_if(rv):
+                    use_cache.put(key, fn.__name__, rv, ttl)
             return rv
-    return _wrapped
+        _wrapped.__name__ = fn.__name__
+        _wrapped.__doc__ = fn.__doc__
+        return _wrapped
+    return _decorator
+
+
+def cache_result(fn):
+    "decorator; cache results of the function forever"
+    return cached()(fn)
+
+
+class FunctionCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = FunctionCache(os.path.join(self.tmpdir, 'test.sqlite'), max_entries=3, touch_interval=0, evict_interval=1)
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def square(self, ttl=None):
+        @cached(ttl=ttl, cache=self.cache)
+        def square(x):
+            self.calls.append(x)
+            return x * x
+        return square
+
+    def test_hit(self):
+        square = self.square()
+        self.assertEqual(square(3), 9)
+        self.assertEqual(square(3), 9)
+        self.assertEqual(self.calls, [3])
+
+    def test_kwargs(self):
+        square = self.square()
+        square(x=3)
+        square(3)
+        self.assertEqual(self.calls, [3, 3])
+
+    def test_ttl(self):
+        square = self.square(ttl=-1)
+        square(3)
+        square(3)
+        self.assertEqual(self.calls, [3, 3])
+
+    def test_evict_lru(self):
+        square = self.square()
+        for x in (1, 2, 3):
+            square(x)
+        # 1 is now the most recently used
+        square(1)
+        square(4)
+        square(1)
+        square(2)
+        self.assertEqual(self.calls, [1, 2, 3, 4, 2])
+
+    def test_evict_interval(self):
+        self.cache.evict_interval = 2
+        square = self.square()
+        for x in (1, 2, 3, 4):
+            square(x)
+        # 4 was written before the check for eviction, so 1 is gone
+        square(1)
+        square(4)
+        self.assertEqual(self.calls, [1, 2, 3, 4, 1])
+
+    def test_cache_if(self):
+        @cached(cache=self.cache, cache_if=lambda rv: rv > 0)
+        def identity(x):
+            self.calls.append(x)
+            return x
+        identity(-1)
+        identity(-1)
+        identity(1)
+        identity(1)
+        self.assertEqual(self.calls, [-1, -1, 1])
+
+    def test_none_cached(self):
+        @cached(cache=self.cache)
+        def nothing():
+            self.calls.append(None)
+        nothing()
+        nothing()
+        self.assertEqual(self.calls, [None])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,123 @@
 
+#
+# geocoding of addresses to (longitude, latitude), via pluggable providers
+#
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+import unittest
 import urllib
-from functioncache import cache_result
+import csv
+from functioncache import cached
+
+# results from remote services are kept for 30 days
+geocode_ttl = 30 * 24 * 60 * 60
+
+
+def geocode_succeeded(data):
+    "whether a response is worth caching; errors such as OVER_QUERY_LIMIT may not recur"
+    try:
+        return json.loads(data).get('status') in ('OK', 'ZERO_RESULTS')
+    except ValueError:
+        return False
 
 
-@cache_result
+@cached(ttl=geocode_ttl, cache_if=geocode_succeeded)
 def geocode(address):
     uri = 'https://maps.googleapis.com/maps/api/geocode/json?address=' + urllib.quote(address) + '&sensor=false'
     req = urllib.urlopen(uri)
     data = req.read()
     req.close()
     return data
+
+
+class GeocodeProvider(object):
+    "a geocoding service; subclasses implement lookup()"
+    def lookup(self, address):
+        "returns (longitude, latitude) for @address, or None if it can't be found"
+        raise NotImplementedError()
+
+    def lookup_many(self, addresses):
+        "returns a list of (address, (longitude, latitude) or None)"
+        return [(address, self.lookup(address)) for address in addresses]
+
+
+class GoogleProvider(GeocodeProvider):
+    def lookup(self, address):
+        try:
+            data = json.loads(geocode(address))
+        except ValueError:
+            return None
+        if data.get('status') != 'OK' or not data.get('results'):
+            return None
+        location = data['results'][0]['geometry']['location']
+        return (location['lng'], location['lat'])
+
+
+class LocalProvider(GeocodeProvider):
+    """offline provider, looking addresses up in a table; for testing, and for
+    addresses which have already been geocoded"""
+    def __init__(self, locations=None):
+        self.locations = {}
+        for address, location in (locations or {}).items():
+            self.add(address, location)
+
+    @classmethod
+    def normalise(cls, address):
+        return ' '.join(address.upper().replace(',', ' ').split())
+
+    @classmethod
+    def from_csv(cls, path):
+        "CSV file with address, longitude and latitude columns"
+        provider = cls()
+        with open(path) as fd:
+            for row in csv.DictReader(fd):
+                provider.add(row['address'], (float(row['longitude']), float(row['latitude'])))
+        return provider
+
+    def add(self, address, location):
+        self.locations[LocalProvider.normalise(address)] = tuple(location)
+
+    def lookup(self, address):
+        return self.locations.get(LocalProvider.normalise(address))
+
+default_provider = GoogleProvider()
+
+
+def geocode_many(addresses, provider=None):
+    "geocode a list of addresses; returns a list of (address, (longitude, latitude) or None)"
+    return (provider or default_provider).lookup_many(addresses)
+
+
+class LocalProviderTests(unittest.TestCase):
+    def setUp(self):
+        self.provider = LocalProvider({
+            '1 Example St, Perth WA 6000': (115.86, -31.95),
+        })
+
+    def test_normalised(self):
+        self.assertEqual(self.provider.lookup('1 example st  perth wa 6000'), (115.86, -31.95))
+
+    def test_missing(self):
+        self.assertEqual(self.provider.lookup('2 Example St, Perth WA 6000'), None)
+
+    def test_many(self):
+        self.assertEqual(
+            geocode_many(['1 Example St, Perth WA 6000', 'nowhere'], provider=self.provider),
+            [('1 Example St, Perth WA 6000', (115.86, -31.95)), ('nowhere', None)])
+
+
+class GeocodeCacheTests(unittest.TestCase):
+    def test_succeeded(self):
+        self.assertTrue(geocode_succeeded('{"status": "OK", "results": []}'))
+        self.assertTrue(geocode_succeeded('{"status": "ZERO_RESULTS", "results": []}'))
+
+    def test_failed(self):
+        self.assertFalse(geocode_succeeded('{"status": "OVER_QUERY_LIMIT", "results": []}'))
+        self.assertFalse(geocode_succeeded('<html>'))
+
+
+if __name__ == '__main__':
+    unittest.main()
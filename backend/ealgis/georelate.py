@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-from .ealgis import EAlGIS
+from db import EAlGIS
 from db import GeometryRelation, GeometryIntersection, GeometryTouches
 import sys
 import time
@@ -3,16 +3,43 @@ try:
 except ImportError:
     import json
 import urllib
-from flask import request, jsonify, abort, Response
+import time
+import sqlalchemy
+from flask import request, jsonify, abort, Response, g
 from flask_login import current_user
 from db import EAlGIS, MapDefinition, Setting, NoMatches, TooManyMatches, CompilationError
-from colour_scale import colour_for_layer, definitions
+from colour_scale import scale_parameters, legends, definitions
+from util import LRUCache
+import metrics
 app = EAlGIS().app
 
 # handler broken out due to complexity of surrounding code
 from mapserver import mapserver_wms  # noqa
 
 
+@app.before_request
+def metrics_request_start():
+    g.request_start = time.time()
+
+
+@app.after_request
+def metrics_request_end(response):
+    # unset if an earlier before_request handler failed
+    start = getattr(g, 'request_start', None)
+    if request.endpoint is not None and start is not None:
+        metrics.observe('ealgis_request_seconds', time.time() - start, endpoint=request.endpoint)
+    metrics.registry.write()
+    return response
+
+
+@app.route("/api/0.1/metrics")
+def api_metrics():
+    return Response(
+        response=metrics.prometheus_text(*metrics.collect()),
+        status=200,
+        content_type='text/plain; version=0.0.4')
+
+
 @app.route("/api/0.1/maps", methods=['POST', 'GET'])
 def api_maps():
     r = {}
@@ -74,6 +101,8 @@ def api_datainfo_table(table_name):
     info['columns'] = columns = {}
     for column in table_info.column_info.all():
         columns[column.name] = json.loads(column.metadata_json)
+        if column.statistics is not None:
+            columns[column.name]['statistics'] = column.statistics.get()
     return jsonify(info)
 
 
@@ -105,23 +134,163 @@ def api_colours():
     return jsonify(definitions.get_json())
 
 
+# (map name, layer id, layer hash) -> colour scale parameters; the layer hash covers
+# the scale parameters, so entries never go stale
+legend_parameters = LRUCache(4096)
+
+
 @app.route("/api/0.1/map/<map_name>/legend/<layer_id>/<client_rev>", methods=['GET'])
 def layer_legend(map_name, layer_id, client_rev):
+    params = legend_parameters.get((map_name, layer_id, client_rev))
+    if params is None:
+        defn_obj = MapDefinition.get_by_name(map_name)
+        if defn_obj is None:
+            abort(404)
+        defn = defn_obj.get()
+        if 'layers' not in defn:
+            abort(404)
+        layer_defn = defn['layers'].get(layer_id, None)
+        if layer_defn is None:
+            abort(404)
+        params = scale_parameters(layer_defn)
+        if layer_defn.get('hash') == client_rev:
+            legend_parameters.put((map_name, layer_id, client_rev), params)
+    etag = legends.etag(params)
+    headers = {'Cache-Control': 'max-age=86400, public', 'ETag': '"%s"' % (etag)}
+    if etag in request.if_none_match:
+        return Response(headers=headers, status=304)
+    etag, png = legends.get(params)
+    return Response(
+        headers=headers,
+        response=png,
+        status=200,
+        content_type='image/png')
+
+
+# most points and addresses looked up in one request; may be overridden by the `lookup_max_batch' setting
+lookup_max_batch = 1000
+
+
+@app.route("/api/0.1/lookup", methods=['POST'])
+def api_lookup():
+    """which features contain a batch of points? takes a JSON object with `points' ([lon, lat] pairs)
+    and/or `addresses' (which are geocoded, for logged in users only), and the `geometry' sources to look
+    in. given a `map' and its `layers', the value of each layer for the containing feature is also returned"""
+    if 'json' in request.form:
+        try:
+            query = json.loads(request.form['json'])
+        except ValueError:
+            abort(400)
+    else:
+        query = request.get_json(silent=True)
+    if not isinstance(query, dict):
+        abort(400)
+    if not all(isinstance(query.get(k, []), list) for k in ('points', 'addresses', 'geometry', 'layers')):
+        abort(400)
+    from pointlookup import lookup_points, layer_values
+    eal = EAlGIS()
+    try:
+        points = [(float(lon), float(lat)) for (lon, lat) in query.get('points', [])]
+    except (TypeError, ValueError):
+        abort(400)
+    results = [{'point': t} for t in points]
+    addresses = query.get('addresses', [])
+    if not all(isinstance(t, basestring) for t in addresses):
+        abort(400)
+    if len(points) + len(addresses) > int(eal.get_setting('lookup_max_batch', lookup_max_batch)):
+        abort(413)
+    if addresses:
+        # geocoding uses the quota of the app's key
+        if not current_user.is_authenticated:
+            abort(401)
+        from geocode import geocode_many
+        for address, location in geocode_many(addresses):
+            results.append({'address': address, 'point': location})
+    layers = {}
+    if 'map' in query:
+        defn_obj = MapDefinition.get_by_name(query['map'])
+        if defn_obj is None:
+            abort(404)
+        defn_layers = defn_obj.get().get('layers', {})
+        for layer_id in query.get('layers', []):
+            if not isinstance(layer_id, basestring) or layer_id not in defn_layers:
+                abort(404)
+            layers[layer_id] = defn_layers[layer_id]['geometry']
+    if not all(isinstance(t, basestring) for t in query.get('geometry', [])):
+        abort(400)
+    geometry_names = set(query.get('geometry', [])) | set(layers.values())
+    located = [t for t in results if t['point'] is not None]
+    for result in results:
+        result['gid'] = {}
+        result['q'] = {}
+    for geometry_name in geometry_names:
+        try:
+            geometry_source = eal.get_geometry_source(geometry_name)
+        except sqlalchemy.orm.exc.NoResultFound:
+            abort(404)
+        gids = lookup_points(geometry_source, [t['point'] for t in located])
+        for result, gid in zip(located, gids):
+            result['gid'][geometry_name] = gid
+    for layer_id, geometry_name in layers.items():
+        values = layer_values(defn_obj, layer_id, [t['gid'][geometry_name] for t in located])
+        for result in located:
+            result['q'][layer_id] = values.get(result['gid'][geometry_name])
+    return jsonify(results=results)
+
+
+@app.route("/api/0.1/map/<map_name>/layer/<layer_id>/value", methods=['GET'])
+def layer_value_at(map_name, layer_id):
+    "the value of a layer at a point (`lon', `lat'), and the gid of the feature there"
+    try:
+        lon = float(request.args['lon'])
+        lat = float(request.args['lat'])
+    except (KeyError, ValueError):
+        abort(400)
     defn_obj = MapDefinition.get_by_name(map_name)
     if defn_obj is None:
         abort(404)
-    defn = defn_obj.get()
-    if 'layers' not in defn:
-        abort(404)
-    layer_defn = defn['layers'].get(layer_id, None)
+    layer_defn = defn_obj.get().get('layers', {}).get(layer_id)
     if layer_defn is None:
         abort(404)
-    scale = colour_for_layer(layer_defn)
-    return Response(
-        headers={'Cache-Control': 'max-age=86400, public'},
-        response=scale.legend(),
-        status=200,
-        content_type='image/png')
+    from pointlookup import lookup_points, layer_value
+    try:
+        geometry_source = EAlGIS().get_geometry_source(layer_defn['geometry'])
+    except sqlalchemy.orm.exc.NoResultFound:
+        abort(404)
+    gid, = lookup_points(geometry_source, [(lon, lat)])
+    q = None
+    if gid is not None:
+        q = layer_value(defn_obj, layer_id, gid)
+    return jsonify(gid=gid, q=q)
+
+
+@app.route("/api/0.1/map/<map_name>/layer/<layer_id>/stats", methods=['GET'])
+@app.route("/api/0.1/map/<map_name>/layer/<layer_id>/stats/<ne>/<sw>", methods=['GET'])
+def layer_stats(map_name, layer_id, ne=None, sw=None):
+    """count, sum, mean, min, max, standard deviation and a histogram of a layer's values;
+    optionally within bounds (as for export-csv), which are snapped outwards to a grid"""
+    defn_obj = MapDefinition.get_by_name(map_name)
+    if defn_obj is None:
+        abort(404)
+    if layer_id not in defn_obj.get().get('layers', {}):
+        abort(404)
+    bounds = None
+    if ne is not None:
+        try:
+            bounds = (tuple(map(float, ne.split(','))), tuple(map(float, sw.split(','))))
+        except ValueError:
+            abort(404)
+        if len(bounds[0]) != 2 or len(bounds[1]) != 2:
+            abort(404)
+    import layerstats
+    try:
+        bins = int(request.args.get('bins', layerstats.nbins))
+    except ValueError:
+        abort(400)
+    if bins < 1 or bins > 1000:
+        abort(400)
+    stats, bounds = layerstats.layer_stats(defn_obj, layer_id, bounds, bins)
+    return jsonify(stats=stats, bounds=bounds)
 
 
 @app.route("/api/0.1/settings")
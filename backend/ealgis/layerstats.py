@@ -0,0 +1,98 @@
+
+#
+# summary statistics, and a histogram, of the values of a map layer
+#
+
+import math
+import sqlalchemy
+from sqlalchemy import func
+from db import EAlGIS
+from pointlookup import layer_expression
+from util import LRUCache
+import prepared
+import metrics
+
+# bounding boxes are snapped outwards to a grid of this size (in degrees), so that
+# nearby views share cached results; overridden by the `stats_grid' setting
+grid = 0.01
+nbins = 20
+
+# (map id, layer id, layer hash, bounds, nbins) -> statistics
+_cache = LRUCache(4096)
+
+
+def quantise_bounds(ne, sw, size):
+    "snap the bounds (ne, sw; each (lat, lon)) outwards onto a grid of @size degrees"
+    return (
+        (math.ceil(ne[0] / size) * size, math.ceil(ne[1] / size) * size),
+        (math.floor(sw[0] / size) * size, math.floor(sw[1] / size) * size))
+
+
+def stats_statement(query, nbins):
+    "a statement computing statistics of the `q' column of @query, see compute_stats()"
+    values = query.cte('layer_values')
+    q = values.c.q
+    stats = sqlalchemy.select([
+        func.count(q).label('count'),
+        func.sum(q).label('sum'),
+        func.avg(q).label('mean'),
+        func.min(q).label('min'),
+        func.max(q).label('max'),
+        func.stddev_samp(q).label('stddev')]).select_from(values).cte('stats')
+    # the maximum belongs in the last bin, rather than one past it
+    bucket = sqlalchemy.case(
+        [(q == None, None),  # noqa
+         (stats.c.min == stats.c.max, 1)],
+        else_=func.least(func.width_bucket(q, stats.c.min, stats.c.max, nbins), nbins)).label('bucket')
+    stat_columns = [stats.c.count, stats.c.sum, stats.c.mean, stats.c.min, stats.c.max, stats.c.stddev]
+    return sqlalchemy.select(stat_columns + [bucket, func.count(q).label('n')]).select_from(
+        stats.outerjoin(values, sqlalchemy.true())).group_by(*(stat_columns + [bucket]))
+
+
+def compute_stats(rows, nbins):
+    "statistics, and a histogram, from the @rows of a stats_statement()"
+    result, histogram = None, [0] * nbins
+    for row in rows:
+        if result is None:
+            result = dict(
+                (k, float(row[k]) if row[k] is not None else None)
+                for k in ('sum', 'mean', 'min', 'max', 'stddev'))
+            result['count'] = row['count']
+        if row['bucket'] is not None:
+            histogram[row['bucket'] - 1] = row['n']
+    result['histogram'] = {
+        'edges': [],
+        'counts': histogram,
+    }
+    if result['min'] is not None:
+        width = (result['max'] - result['min']) / nbins
+        result['histogram']['edges'] = [result['min'] + i * width for i in xrange(nbins + 1)]
+    return result
+
+
+@metrics.timed('layer_stats')
+def layer_stats(defn_obj, layer_id, bounds=None, bins=nbins):
+    """statistics of the values of a map layer, over the whole geometry source, or within
+    @bounds ((lat, lon) of the north-east and south-west corners, in WGS84). returns
+    (statistics, bounds used)"""
+    layer = defn_obj.get()['layers'][layer_id]
+    if bounds is not None:
+        bounds = quantise_bounds(bounds[0], bounds[1], float(EAlGIS().get_setting('stats_grid', grid)))
+    key = (defn_obj.id, layer_id, layer.get('hash'), bounds, bins)
+    stats = _cache.get(key)
+    if stats is not None:
+        metrics.inc('ealgis_cache_total', cache='layer_stats', result='hit')
+        return stats, bounds
+    metrics.inc('ealgis_cache_total', cache='layer_stats', result='miss')
+
+    def _build():
+        expr = layer_expression(defn_obj, layer_id)
+        if bounds is None:
+            return stats_statement(expr.get_query(), bins)
+        return stats_statement(expr.get_query_bounds(*prepared.bounds_placeholders, srid=4326), bins)
+    # the bounds are parameters, so one statement serves every view of the layer
+    sql = prepared.statement_sql((defn_obj.id, layer_id, layer.get('hash'), 'stats', bins, bounds is None), _build)
+    params = prepared.bounds_parameters(bounds) if bounds is not None else []
+    stats = compute_stats(prepared.execute(sql, params), bins)
+    _cache.put(key, stats)
+    return stats, bounds
@@ -4,12 +4,20 @@ import zipfile
 import sqlalchemy
 import subprocess
 import glob
-from util import piperun, table_name_valid
-from itertools import izip
-from seqclassifier import SequenceClassifier
+from util import piperun, table_name_valid, IterStream
+from seqclassifier import classify_columns
+import multiprocessing
+import traceback
+import psycopg2
+import itertools
+import datetime
+import struct
 import osr
+import ogr
 import sys
 import csv
+import time
+import tempfile
 
 
 class LoaderException(Exception):
@@ -89,6 +97,111 @@ class RewrittenCSV(object):
         os.unlink(self._path)
 
 
+def _run_task(task):
+    "run a single loader task; invoked within a worker process"
+    from db import EAlGIS
+    eal = EAlGIS()
+    try:
+        if hasattr(task, 'load'):
+            task.load(eal)
+        else:
+            task(eal)
+        eal.db.session.commit()
+        return None
+    except Exception:
+        eal.db.session.rollback()
+        return traceback.format_exc()
+
+
+class LoadRunner(object):
+    """runs loader tasks, in a pool of worker processes where they are
+    independent of one another. a task is a loader (an object with a `load'
+    method, eg. ShapeLoader or CSVLoader) or a module-level function taking
+    the EAlGIS instance; each task is run after the tasks it depends upon
+    have completed successfully"""
+
+    def __init__(self, eal, jobs=1):
+        self.eal = eal
+        self.jobs = max(1, jobs)
+        self.tasks = []
+
+    def submit(self, task, depends=()):
+        "queue `task' to be run; returns a handle which can be passed to later submit calls in `depends'"
+        depends = frozenset(depends)
+        handle = len(self.tasks)
+        # only earlier tasks may be depended upon, so there can be no cycles
+        if any(t < 0 or t >= handle for t in depends):
+            raise LoaderException("task dependencies must be on previously submitted tasks")
+        self.tasks.append((task, depends))
+        return handle
+
+    def _describe(self, handle):
+        task = self.tasks[handle][0]
+        return getattr(task, 'table_name', None) or getattr(task, '__name__', None) or repr(task)
+
+    def _run_serial(self):
+        failed = set()
+        for handle, (task, depends) in enumerate(self.tasks):
+            if depends & failed:
+                print "skipped (dependency failed): %s" % (self._describe(handle))
+                failed.add(handle)
+                continue
+            error = _run_task(task)
+            if error is not None:
+                print >>sys.stderr, "task failed: %s\n%s" % (self._describe(handle), error)
+                failed.add(handle)
+        return failed
+
+    def _run_parallel(self):
+        # worker processes are forked, and must not inherit our database connections
+        self.eal.db.session.commit()
+        self.eal.db.session.close()
+        self.eal.db.engine.dispose()
+        pending = set(range(len(self.tasks)))
+        running = {}
+        done, failed = set(), set()
+        pool = multiprocessing.Pool(self.jobs)
+        try:
+            while pending or running:
+                for handle in sorted(pending):
+                    depends = self.tasks[handle][1]
+                    if depends & failed:
+                        print "skipped (dependency failed): %s" % (self._describe(handle))
+                        pending.remove(handle)
+                        failed.add(handle)
+                    elif depends <= done and len(running) < self.jobs:
+                        print "starting: %s" % (self._describe(handle))
+                        pending.remove(handle)
+                        running[handle] = pool.apply_async(_run_task, (self.tasks[handle][0], ))
+                for handle, result in running.items():
+                    if not result.ready():
+                        continue
+                    del running[handle]
+                    error = result.get()
+                    if error is None:
+                        print "completed: %s" % (self._describe(handle))
+                        done.add(handle)
+                    else:
+                        print >>sys.stderr, "task failed: %s\n%s" % (self._describe(handle), error)
+                        failed.add(handle)
+                time.sleep(0.2)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        return failed
+
+    def run(self):
+        "run all submitted tasks; raises LoaderException if any task failed"
+        if self.jobs == 1:
+            failed = self._run_serial()
+        else:
+            failed = self._run_parallel()
+        self.tasks = []
+        if failed:
+            raise LoaderException("%d load task(s) failed or were skipped." % (len(failed)))
+
+
 class GeoDataLoader(object):
     @classmethod
     def get_file_base(cls, fname):
@@ -161,6 +274,148 @@ class ShapeLoader(GeoDataLoader):
         eal.register_table(self.table_name, geom=True, srid=self.srid, gid='gid')
 
 
+class CopyShapeLoader(ShapeLoader):
+    """loads a shapefile in-process: features are read with OGR and streamed
+    into PostgreSQL with binary COPY, rather than piping shp2pgsql into psql.
+    the table is created UNLOGGED (where the server supports switching it
+    to LOGGED afterwards), and indexes are built once the data is loaded"""
+
+    PGCOPY_HEADER = 'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+    PGCOPY_TRAILER = struct.pack('>h', -1)
+    PG_EPOCH = datetime.date(2000, 1, 1)
+    # shapefiles only hold single polygons and linestrings; like shp2pgsql,
+    # we promote these to their multi- equivalent
+    GEOMETRY_TYPES = {
+        ogr.wkbPoint: ('POINT', None),
+        ogr.wkbMultiPoint: ('MULTIPOINT', None),
+        ogr.wkbLineString: ('MULTILINESTRING', ogr.ForceToMultiLineString),
+        ogr.wkbMultiLineString: ('MULTILINESTRING', ogr.ForceToMultiLineString),
+        ogr.wkbPolygon: ('MULTIPOLYGON', ogr.ForceToMultiPolygon),
+        ogr.wkbMultiPolygon: ('MULTIPOLYGON', ogr.ForceToMultiPolygon),
+    }
+    geom_column = 'geom'
+
+    def __init__(self, shppath, srid=None, table_name=None, encoding='utf-8', batch_size=10000):
+        super(CopyShapeLoader, self).__init__(shppath, srid=srid, table_name=table_name)
+        self.encoding = encoding
+        self.batch_size = batch_size
+
+    def _field_codecs(self, layer_defn):
+        "returns a list of (column name, SQL type, encoder) for the attribute fields of the layer"
+
+        def enc_integer(feature, idx):
+            return struct.pack('>i', feature.GetFieldAsInteger(idx))
+
+        def enc_real(feature, idx):
+            return struct.pack('>d', feature.GetFieldAsDouble(idx))
+
+        def enc_date(feature, idx):
+            y, m, d = feature.GetFieldAsDateTime(idx)[:3]
+            return struct.pack('>i', (datetime.date(y, m, d) - CopyShapeLoader.PG_EPOCH).days)
+
+        def enc_text(feature, idx):
+            return feature.GetFieldAsString(idx).decode(self.encoding).encode('utf8')
+
+        codecs = []
+        for idx in xrange(layer_defn.GetFieldCount()):
+            field_defn = layer_defn.GetFieldDefn(idx)
+            name = field_defn.GetName().lower()
+            if name in ('gid', CopyShapeLoader.geom_column):
+                name = '__' + name
+            field_type = field_defn.GetType()
+            if field_type == ogr.OFTInteger:
+                codecs.append((name, 'integer', enc_integer))
+            elif field_type == ogr.OFTReal:
+                codecs.append((name, 'double precision', enc_real))
+            elif field_type == ogr.OFTDate:
+                codecs.append((name, 'date', enc_date))
+            else:
+                codecs.append((name, 'varchar', enc_text))
+        return codecs
+
+    def _copy_rows(self, layer, codecs, make_multi):
+        "generator yielding features of the layer in PostgreSQL binary COPY row format"
+        nfields = struct.pack('>h', len(codecs) + 2)
+        null = struct.pack('>i', -1)
+        ewkb_srid = struct.pack('<I', self.srid)
+
+        def field(data):
+            return struct.pack('>i', len(data)) + data
+
+        gid = 0
+        for feature in layer:
+            gid += 1
+            parts = [nfields, field(struct.pack('>i', gid))]
+            for idx, (_, _, encode) in enumerate(codecs):
+                if feature.IsFieldSet(idx):
+                    parts.append(field(encode(feature, idx)))
+                else:
+                    parts.append(null)
+            geom = feature.GetGeometryRef()
+            if geom is None:
+                parts.append(null)
+            else:
+                geom.FlattenTo2D()
+                if make_multi is not None:
+                    geom = make_multi(geom)
+                wkb = geom.ExportToWkb(ogr.wkbNDR)
+                # WKB -> EWKB, so that the geometry carries our SRID
+                wkb_type = struct.unpack('<I', wkb[1:5])[0]
+                parts.append(field(struct.pack('<BI', 1, wkb_type | 0x20000000) + ewkb_srid + wkb[5:]))
+            yield ''.join(parts)
+
+    def _batches(self, rows):
+        "split `rows' into COPY streams of at most `batch_size' rows"
+        rows = iter(rows)
+        while True:
+            batch = list(itertools.islice(rows, self.batch_size))
+            if not batch:
+                return
+            yield [CopyShapeLoader.PGCOPY_HEADER] + batch + [CopyShapeLoader.PGCOPY_TRAILER]
+
+    def load(self, eal):
+        if eal.have_table(self.table_name):
+            print "already loaded: %s" % (self.table_name)
+            return
+        datasource = ogr.Open(self.shppath)
+        if datasource is None:
+            raise LoaderException("unable to open %s." % self.shpname)
+        layer = datasource.GetLayer(0)
+        codecs = self._field_codecs(layer.GetLayerDefn())
+        geometry_type, make_multi = CopyShapeLoader.GEOMETRY_TYPES.get(
+            layer.GetGeomType() & ~ogr.wkb25DBit, ('GEOMETRY', None))
+
+        conn = eal.db.session.connection()
+        # switching an UNLOGGED table to LOGGED requires PostgreSQL 9.5
+        unlogged = int(conn.execute('SHOW server_version_num').scalar()) >= 90500
+        column_defs = ['gid integer'] + ['"%s" %s' % (name, sql_type) for (name, sql_type, _) in codecs]
+        column_defs.append('%s geometry(%s, %d)' % (CopyShapeLoader.geom_column, geometry_type, self.srid))
+        conn.execute('CREATE %s TABLE %s (%s)' % ('UNLOGGED' if unlogged else '', self.table_name, ', '.join(column_defs)))
+        copy_sql = 'COPY %s (%s) FROM STDIN WITH (FORMAT binary)' % (
+            self.table_name,
+            ', '.join(['gid'] + ['"%s"' % (name) for (name, _, _) in codecs] + [CopyShapeLoader.geom_column]))
+
+        cursor = conn.connection.cursor()
+        nrows, start = 0, time.time()
+        for batch in self._batches(self._copy_rows(layer, codecs, make_multi)):
+            cursor.copy_expert(copy_sql, IterStream(batch))
+            nrows += len(batch) - 2
+            print "%s: %d rows loaded (%.0f rows/s)" % (self.table_name, nrows, nrows / max(time.time() - start, 1e-3))
+        cursor.close()
+        del layer, datasource
+
+        # deferred until the data is in place
+        if unlogged:
+            conn.execute('ALTER TABLE %s SET LOGGED' % (self.table_name))
+        conn.execute('ALTER TABLE %s ADD PRIMARY KEY (gid)' % (self.table_name))
+        conn.execute('ANALYZE %s' % (self.table_name))
+        eal.db.session.commit()
+        # registering repairs invalid geometry; the spatial index is built afterwards, with those of
+        # the reprojected columns
+        print "registering, table name is:", self.table_name
+        eal.register_table(self.table_name, geom=True, srid=self.srid, gid='gid')
+
+
 class MapInfoLoader(GeoDataLoader):
     def __init__(self, filename, srid, table_name=None):
         self.filename = filename
@@ -226,58 +481,125 @@ class KMLLoader(GeoDataLoader):
 
 
 class CSVLoader(GeoDataLoader):
-    def __init__(self, table_name, csvpath, pkey_column=None):
+    def __init__(self, table_name, csvpath, pkey_column=None, sample_rows=10000, max_columns=None):
         self.table_name = table_name
         self.csvpath = csvpath
         self.pkey_column = pkey_column
+        # column types are inferred from this many rows; None to examine the whole file
+        self.sample_rows = sample_rows
+        # wide tables may be split into column groups, each stored in its own
+        # table with at most this many columns (including the primary key)
+        self.max_columns = max_columns
+
+    def column_groups(self, ncolumns):
+        "returns a list of (physical table name, [column index, ...])"
+        if self.max_columns is None or ncolumns <= self.max_columns:
+            return [(self.table_name, range(ncolumns))]
+        if self.pkey_column is None:
+            raise LoaderException("splitting `%s' into column groups requires a pkey_column" % (self.table_name))
+        if self.max_columns < 2:
+            raise LoaderException("max_columns must be at least 2")
+        others = [idx for idx in xrange(ncolumns) if idx != self.pkey_column]
+        per_group = self.max_columns - 1
+        return [
+            ("%s_g%d" % (self.table_name, n), [self.pkey_column] + others[i:i + per_group])
+            for n, i in enumerate(xrange(0, len(others), per_group))]
+
+    def split_csv(self, groups, width):
+        """split the CSV file, in one pass, into a temporary file for each of the column @groups; every
+        row must have @width columns"""
+        files = [tempfile.TemporaryFile() for _ in groups]
+        writers = [csv.writer(t) for t in files]
+        with open(self.csvpath) as fd:
+            r = csv.reader(fd)
+            for row in r:
+                if len(row) != width:
+                    for t in files:
+                        t.close()
+                    raise LoaderException("%s, line %d: expected %d columns, found %d" % (
+                        os.path.basename(self.csvpath), r.line_num, width, len(row)))
+                for (_, indexes), w in zip(groups, writers):
+                    w.writerow([row[idx] for idx in indexes])
+        return files
 
     def load(self, eal, column_types=None):
         db = eal.db
+        sql_columns = {
+            int: db.Integer,
+            float: db.Float,
+            str: db.Text
+        }
 
-        def get_column_types(header, max_rows=None):
-            sql_columns = {
-                int: db.Integer,
-                float: db.Float,
-                str: db.Text
-            }
+        def get_column_types(header, max_rows):
             if column_types is not None:
-                return [sql_columns[t] for t in column_types]
-            classifiers = [SequenceClassifier() for column in header]
-            for i, row in enumerate(r):
-                for classifier, value in izip(classifiers, row):
-                    classifier.update(value)
-                if max_rows is not None and i == max_rows:
-                    break
-            return [sql_columns[t.get()] for t in classifiers]
-
-        def columns(header):
+                return column_types, True
+            with open(self.csvpath) as fd:
+                r = csv.reader(fd)
+                next(r)
+                rows = list(itertools.islice(r, max_rows))
+                exhaustive = max_rows is None or next(r, None) is None
+            return classify_columns(rows, len(header)), exhaustive
+
+        def columns(header, types, indexes):
             coldefs = []
-            for idx, (column_name, ty) in enumerate(izip(header, get_column_types(header))):
+            for idx in indexes:
                 make_index = idx == self.pkey_column
                 coldefs.append(db.Column(
-                    column_name.lower(),
-                    ty,
+                    header[idx].lower(),
+                    sql_columns[types[idx]],
                     index=make_index,
                     unique=make_index,
                     primary_key=make_index))
             return coldefs
 
-        # smell the file, generate a SQLAlchemy table definition
-        # and then make it
         with open(self.csvpath) as fd:
-            r = csv.reader(fd)
-            header = next(r)
-            cols = columns(header)
-        metadata = eal.db.MetaData()
-        new_tbl = db.Table(self.table_name, metadata, *cols)
-        metadata.create_all(eal.db.engine)
-        eal.db.session.commit()
-        del new_tbl
+            header = next(csv.reader(fd))
+        groups = self.column_groups(len(header))
 
-        # this isn't wrapped by SQLAlchemy, so we must do it ourselves;
-        # invoke the Postgres CSV loader
-        conn = db.session.connection()
-        conn.execute('COPY %s FROM %%s CSV HEADER' % (self.table_name), (self.csvpath, ))
+        group_files = None
+        if len(groups) > 1:
+            group_files = self.split_csv(groups, len(header))
+
+        try:
+            # the column types are guessed from a sample of the file; should the
+            # guess turn out to be wrong, we retry having examined every row
+            max_rows = self.sample_rows
+            while True:
+                types, exhaustive = get_column_types(header, max_rows)
+                metadata = eal.db.MetaData()
+                new_tbls = [db.Table(table_name, metadata, *columns(header, types, indexes)) for (table_name, indexes) in groups]
+                metadata.create_all(eal.db.engine)
+                eal.db.session.commit()
+                try:
+                    # stream the file to the server; this isn't wrapped by SQLAlchemy,
+                    # so we must do it ourselves
+                    cursor = db.session.connection().connection.cursor()
+                    for n, (table_name, indexes) in enumerate(groups):
+                        copy_sql = 'COPY %s FROM STDIN CSV HEADER' % (table_name)
+                        if group_files is None:
+                            with open(self.csvpath) as fd:
+                                cursor.copy_expert(copy_sql, fd)
+                        else:
+                            group_files[n].seek(0)
+                            cursor.copy_expert(copy_sql, group_files[n])
+                    cursor.close()
+                    break
+                except psycopg2.DataError:
+                    db.session.rollback()
+                    metadata.drop_all(eal.db.engine)
+                    if exhaustive:
+                        raise
+                    print "column types for %s could not be determined from a sample, examining every row" % (self.table_name)
+                    max_rows = None
+            del new_tbls
+        finally:
+            for t in group_files or []:
+                t.close()
         ti = eal.register_table(self.table_name)
+        if len(groups) > 1:
+            storage = {}
+            for table_name, indexes in reversed(groups):
+                storage.update((header[idx].lower(), table_name) for idx in indexes)
+            eal.register_column_storage(self.table_name, sorted(storage.items()))
         db.session.commit()
         return ti
@@ -5,6 +5,10 @@ import os
 import mapscript
 from db import EAlGIS, MapDefinition
 from colour_scale import colour_for_layer
+from explain import sample_slow_tile
+from util import LRUCache
+import metrics
+import time
 
 
 # mapserver utility functions
@@ -120,27 +124,51 @@ class Layer(object):
         # above cmin
         add_class(scale.lookup(cmax + inc), "([%s] >= %g)" % (attr, cmax))
 
-mapscript.msIO_installStdoutToBuffer()
-
 
 class Map(object):
-    def __init__(self, rev, defn):
+    def __init__(self, rev, layer_defns):
+        "@layer_defns is a list of (name, layer definition), drawn in that order"
         self.instance = mapscript.mapObj(os.path.expanduser('/app/backend/mapserver/template.map'))
         self.instance.imagetype = 'png'
         self.instance.setProjection('init=epsg:%s' % (EAlGIS().get_setting('map_srid')))
         self.rev = rev
         self.layers = []
-        self.layers.append(self.make_base_layer(defn))
+        # every layer has the same connection string, and defers closing its
+        # connection, so MapServer draws all the layers over one connection
+        for name, layer_defn in layer_defns:
+            self.layers.append(Layer(self.instance, name, layer_defn))
+
 
-    def make_base_layer(self, layer_defn):
-        layer = Layer(self.instance, "base", layer_defn)
-        return layer
+def visible_layer_ids(defn):
+    "the visible layers of a map, in the order the frontend stacks them: filled layers below outlines"
+    layers = defn.get('layers', {})
+    visible = [k for k in sorted(layers) if layers[k].get('visible', True)]
+    return [k for k in visible if layers[k]['fill']['expression'] != ''] + \
+        [k for k in visible if layers[k]['fill']['expression'] == '']
 
 
 class MapInstances(object):
     def __init__(self):
-        self.instances = {}
+        self.instances = LRUCache(256)
+        self.stdout_buffered = False
+
+    def _get_or_create(self, key, rev, make_layer_defns):
+        wrapper = self.instances.get(key)
+        if wrapper is not None and wrapper.rev != rev:
+            wrapper = None
+        if wrapper is None:
+            if not self.stdout_buffered:
+                # done on first use, in each worker process, rather than at import time
+                mapscript.msIO_installStdoutToBuffer()
+                self.stdout_buffered = True
+            metrics.inc('ealgis_cache_total', cache='map_instance', result='miss')
+            wrapper = Map(rev, make_layer_defns())
+            self.instances.put(key, wrapper)
+        else:
+            metrics.inc('ealgis_cache_total', cache='map_instance', result='hit')
+        return wrapper
 
+    @metrics.timed('map_instance')
     def get_or_create(self, map_name, layer_id):
         defn_obj = MapDefinition.get_by_name(map_name)
         if defn_obj is None:
@@ -152,27 +180,36 @@ class MapInstances(object):
         layer_defn = defn['layers'].get(layer_id, None)
         if layer_defn is None:
             return None
-        key = (defn_obj.id, layer_id)
-        wrapper = self.instances.get(key, None)
-        if wrapper is not None and wrapper.rev != rev:
-            wrapper = None
-            del self.instances[key]
-        if wrapper is None:
-            wrapper = Map(rev, layer_defn)
-            self.instances[key] = wrapper
-        return wrapper
+        return self._get_or_create((defn_obj.id, layer_id), rev, lambda: [("base", layer_defn)])
+
+    @metrics.timed('map_instance')
+    def get_or_create_multi(self, map_name, layer_ids=None):
+        """a map instance drawing several layers of a map into one image; by default,
+        all visible layers. returns (instance, layer ids drawn)"""
+        defn_obj = MapDefinition.get_by_name(map_name)
+        if defn_obj is None:
+            return None, None
+        defn = defn_obj.get()
+        rev = defn.get('rev', 0)
+        layers = defn.get('layers', {})
+        if layer_ids is None:
+            layer_ids = visible_layer_ids(defn)
+        if not layer_ids or any(t not in layers for t in layer_ids):
+            return None, None
+        wrapper = self._get_or_create(
+            (defn_obj.id, tuple(layer_ids)), rev,
+            lambda: [(layer_id, layers[layer_id]) for layer_id in layer_ids])
+        return wrapper, layer_ids
 
 instances = MapInstances()
 
 app = EAlGIS().app
 
 
-@app.route("/api/0.1/map/<map_name>/mapserver_wms/<layer_id>/<client_rev>", methods=['GET'])
-@login_required
-def mapserver_wms(map_name, layer_id, client_rev):
-    wrapper = instances.get_or_create(map_name, layer_id)
-    if wrapper is None:
-        abort(404)
+def dispatch(map_name, wrapper, sample_layer_id=None):
+    """draw using @wrapper; if @sample_layer_id is given, a slow draw may have the plan of
+    that layer's query captured. MapServer draws the layers of a multi-layer image in turn,
+    and its time can't be put down to any one of them, so those aren't sampled"""
     # load in request parameters
     req = mapscript.OWSRequest()
     for (k, v) in request.args.iteritems():
@@ -182,12 +219,46 @@ def mapserver_wms(map_name, layer_id, client_rev):
     # shared stdio buffer object thing; make sure that there's nothing left over
     # from an aborted request stuck in there
     mapscript.msIO_getStdoutBufferBytes()
+    start = time.time()
     try:
-        wrapper.instance.OWSDispatch(req)
+        with metrics.phase_timer('ows_dispatch'):
+            wrapper.instance.OWSDispatch(req)
         headers = {'Cache-Control': 'max-age=86400, public'}
     except mapscript.MapServerError:
         # don't cache errors
         headers = {}
     content_type = mapscript.msIO_stripStdoutBufferContentType()
     content = mapscript.msIO_getStdoutBufferBytes()
+    try:
+        # WMS parameter names are case-insensitive
+        bbox = next((v for (k, v) in request.args.iteritems() if k.upper() == 'BBOX'), '')
+        bbox = map(float, bbox.split(','))
+    except ValueError:
+        bbox = None
+    if sample_layer_id is not None and bbox is not None and len(bbox) == 4:
+        sample_slow_tile(map_name, sample_layer_id, bbox, time.time() - start)
     return Response(headers=headers, response=content, status=200, content_type=content_type)
+
+
+@app.route("/api/0.1/map/<map_name>/mapserver_wms/<layer_id>/<client_rev>", methods=['GET'])
+@login_required
+def mapserver_wms(map_name, layer_id, client_rev):
+    wrapper = instances.get_or_create(map_name, layer_id)
+    if wrapper is None:
+        abort(404)
+    return dispatch(map_name, wrapper, sample_layer_id=layer_id)
+
+
+@app.route("/api/0.1/map/<map_name>/mapserver_wms_multi/<client_rev>", methods=['GET'])
+@login_required
+def mapserver_wms_multi(map_name, client_rev):
+    """draw several layers of a map as one image; the `ealgis_layers' parameter gives the layer ids,
+    bottom first (by default, all visible layers). @client_rev should change with the map revision,
+    as responses are cached"""
+    layer_ids = request.args.get('ealgis_layers')
+    if layer_ids is not None:
+        layer_ids = layer_ids.split(',')
+    wrapper, layer_ids = instances.get_or_create_multi(map_name, layer_ids)
+    if wrapper is None:
+        abort(404)
+    return dispatch(map_name, wrapper)
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+
+#
+# timing histograms and counters, reported in the Prometheus text format
+#
+# each process (eg. uWSGI worker) keeps its own metrics, and from time to
+# time writes them to a file in a shared directory; the metrics endpoint
+# merges the files of all workers. the metrics of processes which have
+# exited are folded into a file of their own, so that counts don't go
+# backwards when workers are replaced.
+#
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+from contextlib import contextmanager
+from functools import wraps
+import threading
+import socket
+import atexit
+import fcntl
+import errno
+import glob
+import time
+import os
+
+metrics_path = '/data/metrics/'
+# seconds between writes of a process' metrics to its file
+write_interval = 5
+
+buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+help_text = {
+    'ealgis_request_seconds': 'Time taken to handle requests, by endpoint',
+    'ealgis_phase_seconds': 'Time spent in phases of request handling',
+    'ealgis_cache_total': 'Cache lookups, by cache and result',
+}
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def _process_file(pid):
+    return os.path.join(metrics_path, '%s-%d.json' % (socket.gethostname(), pid))
+
+
+def _merge(snapshot, histograms, counters):
+    for name, labels, values in snapshot['histograms']:
+        key = _key(name, labels)
+        if key not in histograms:
+            histograms[key] = [0] * len(values)
+        histograms[key] = [a + b for (a, b) in zip(histograms[key], values)]
+    for name, labels, value in snapshot['counters']:
+        key = _key(name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+
+def _snapshot(histograms, counters):
+    return {
+        'histograms': [[name, dict(labels), v] for (name, labels), v in histograms.items()],
+        'counters': [[name, dict(labels), v] for (name, labels), v in counters.items()],
+    }
+
+
+def _read(path):
+    try:
+        with open(path) as fd:
+            return json.load(fd)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _write(path, snapshot):
+    with open(path + '.tmp', 'w') as fd:
+        json.dump(snapshot, fd)
+    os.rename(path + '.tmp', path)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+class Registry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        # (name, labels) -> [count in each bucket (the last is +Inf), sum]
+        self.histograms = {}
+        # (name, labels) -> count
+        self.counters = {}
+        self.last_write = 0
+        self.dirty = False
+        self.flusher = None
+
+    def _check_process(self):
+        """called with the lock held. starts a thread to write out this process' metrics, even when no
+        requests arrive. a forked process (eg. a uWSGI worker) starts its own thread, as threads don't
+        survive a fork, and starts with no metrics, as those inherited are reported by its parent"""
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.histograms = {}
+            self.counters = {}
+            self.last_write = 0
+            self.dirty = False
+            self.flusher = None
+        if self.flusher is None:
+            self.flusher = threading.Thread(target=self._flush)
+            self.flusher.daemon = True
+            self.flusher.start()
+
+    def _flush(self):
+        while True:
+            time.sleep(write_interval)
+            if self.dirty:
+                self.write(force=True)
+
+    def observe(self, name, value, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            self._check_process()
+            self.dirty = True
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [0] * (len(buckets) + 2)
+            idx = 0
+            while idx < len(buckets) and value > buckets[idx]:
+                idx += 1
+            hist[idx] += 1
+            hist[-1] += value
+
+    def inc(self, name, n=1, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            self._check_process()
+            self.dirty = True
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def snapshot(self):
+        with self.lock:
+            self._check_process()
+            self.dirty = False
+            return _snapshot(self.histograms, self.counters)
+
+    def write(self, force=False):
+        "write this process' metrics to the shared directory (at most every `write_interval' seconds, unless forced)"
+        now = time.time()
+        if not force and now - self.last_write < write_interval:
+            return
+        self.last_write = now
+        try:
+            if not os.path.isdir(metrics_path):
+                os.makedirs(metrics_path)
+            _write(_process_file(os.getpid()), self.snapshot())
+        except (IOError, OSError):
+            # metrics must never break the application
+            pass
+
+registry = Registry()
+
+
+@atexit.register
+def _write_at_exit():
+    if registry.dirty:
+        registry.write(force=True)
+
+
+def observe(name, value, **labels):
+    registry.observe(name, value, **labels)
+
+
+def inc(name, n=1, **labels):
+    registry.inc(name, n, **labels)
+
+
+@contextmanager
+def phase_timer(phase):
+    "time the enclosed block, recording it as @phase"
+    start = time.time()
+    try:
+        yield
+    finally:
+        observe('ealgis_phase_seconds', time.time() - start, phase=phase)
+
+
+def timed(phase):
+    "decorator; time calls of the function, recording them as @phase"
+    def _decorator(fn):
+        @wraps(fn)
+        def _wrapped(*args, **kwargs):
+            with phase_timer(phase):
+                return fn(*args, **kwargs)
+        return _wrapped
+    return _decorator
+
+
+def instrument_engine(engine):
+    "record the time taken by each query run through the SQLAlchemy engine"
+    from sqlalchemy import event
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('_metrics_query_start', []).append(time.time())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        observe('ealgis_phase_seconds', time.time() - conn.info['_metrics_query_start'].pop(), phase='db_query')
+
+
+def retire_exited():
+    "fold the files of this host's processes which have exited into the host's `exited' file"
+    prefix = socket.gethostname() + '-'
+    exited_path = os.path.join(metrics_path, prefix + 'exited.json')
+    with open(os.path.join(metrics_path, '.lock'), 'w') as lock:
+        # only one process may fold in a file, or it would be counted twice
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        dead = []
+        for path in glob.glob(os.path.join(metrics_path, prefix + '*.json')):
+            pid = os.path.basename(path)[len(prefix):-len('.json')]
+            if pid.isdigit() and not _alive(int(pid)):
+                dead.append(path)
+        if not dead:
+            return
+        histograms, counters = {}, {}
+        for path in [exited_path] + dead:
+            snapshot = _read(path)
+            if snapshot is not None:
+                _merge(snapshot, histograms, counters)
+        _write(exited_path, _snapshot(histograms, counters))
+        for path in dead:
+            os.unlink(path)
+
+
+def collect():
+    "merge the metrics of every process"
+    registry.write(force=True)
+    try:
+        retire_exited()
+    except (IOError, OSError):
+        pass
+    histograms, counters = {}, {}
+    for path in glob.glob(os.path.join(metrics_path, '*.json')):
+        snapshot = _read(path)
+        if snapshot is not None:
+            _merge(snapshot, histograms, counters)
+    return histograms, counters
+
+
+def prometheus_text(histograms, counters):
+    def fmt_labels(labels, extra=()):
+        labels = list(labels) + list(extra)
+        if not labels:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for (k, v) in labels)
+
+    lines = []
+    seen = set()
+
+    def header(name, kind):
+        if name in seen:
+            return
+        seen.add(name)
+        if name in help_text:
+            lines.append('# HELP %s %s' % (name, help_text[name]))
+        lines.append('# TYPE %s %s' % (name, kind))
+
+    for (name, labels) in sorted(histograms):
+        values = histograms[(name, labels)]
+        header(name, 'histogram')
+        cumulative = 0
+        for le, count in zip(buckets + ('+Inf', ), values[:-1]):
+            cumulative += count
+            lines.append('%s_bucket%s %d' % (name, fmt_labels(labels, [('le', le)]), cumulative))
+        lines.append('%s_sum%s %f' % (name, fmt_labels(labels), values[-1]))
+        lines.append('%s_count%s %d' % (name, fmt_labels(labels), cumulative))
+    for (name, labels) in sorted(counters):
+        header(name, 'counter')
+        lines.append('%s%s %d' % (name, fmt_labels(labels), counters[(name, labels)]))
+    return '\n'.join(lines) + '\n'
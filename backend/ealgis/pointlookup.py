@@ -0,0 +1,194 @@
+
+#
+# which feature of a geometry source contains a point?
+#
+# answered, where possible, from a per-process R-tree (STRtree) of simplified
+# polygons; that needs shapely, and is only built for sources of moderate size.
+# points close to a simplified boundary, where the simplification may give the
+# wrong answer, are looked up in the database, using the geometry's GiST index.
+#
+
+try:
+    from shapely import wkb
+    from shapely.geometry import Point, box
+    from shapely.prepared import prep
+    from shapely.strtree import STRtree
+except ImportError:
+    STRtree = None
+import sqlalchemy
+from db import EAlGIS
+from util import LRUCache
+import prepared
+import metrics
+
+# defaults; may be overridden by the `point_lookup_tolerance' (degrees) and
+# `point_lookup_max_features' settings
+tolerance = 0.0001
+max_features = 250000
+
+# geometry source id -> PolygonIndex, or None if the source won't be indexed
+_indexes = LRUCache(16)
+_table_classes = LRUCache(64)
+# (map id, layer id, layer hash) -> compiled DataExpression
+_expressions = LRUCache(64)
+# (map id, layer id, layer hash, gid) -> q
+_values = LRUCache(65536)
+
+
+def table_class(geometry_source):
+    tbl = _table_classes.get(geometry_source.id)
+    if tbl is None:
+        tbl = EAlGIS().get_table_class(geometry_source.table_info.name)
+        _table_classes.put(geometry_source.id, tbl)
+    return tbl
+
+
+def wgs84_geometry(geometry_source, tbl):
+    "the geometry of @geometry_source in WGS84 (EPSG:4326)"
+    column = geometry_source.srid_column(4326)
+    if column is not None:
+        return getattr(tbl, column)
+    return sqlalchemy.func.st_transform(getattr(tbl, geometry_source.column), 4326)
+
+
+def db_lookup(geometry_source, lon, lat):
+    "gid of the feature containing (@lon, @lat), queried from the database"
+    eal = EAlGIS()
+    tbl = table_class(geometry_source)
+    point = sqlalchemy.func.st_setsrid(sqlalchemy.func.st_makepoint(lon, lat), 4326)
+    # as in DataExpression.bounds_column; use a column in our SRID if there is one,
+    # otherwise the projected column
+    column = geometry_source.srid_column(4326)
+    if column is None:
+        proj_srid = int(eal.get_setting('projected_srid'))
+        column = geometry_source.srid_column(proj_srid)
+        point = sqlalchemy.func.st_transform(point, proj_srid)
+    gid_attr = getattr(tbl, geometry_source.gid)
+    return eal.db.session.query(gid_attr).filter(
+        sqlalchemy.func.st_contains(getattr(tbl, column), point)).order_by(gid_attr).limit(1).scalar()
+
+
+class PolygonIndex(object):
+    "simplified polygons of a geometry source, in WGS84, in an STRtree"
+    def __init__(self, geometry_source, tolerance):
+        eal = EAlGIS()
+        tbl = table_class(geometry_source)
+        geom = wgs84_geometry(geometry_source, tbl)
+        self.tolerance = tolerance
+        self.gids = []
+        self.polygons = []
+        self.prepared = []
+        q = eal.db.session.query(
+            getattr(tbl, geometry_source.gid),
+            sqlalchemy.func.st_asbinary(sqlalchemy.func.st_simplifypreservetopology(geom, tolerance))).filter(geom != None)  # noqa
+        for gid, data in q.yield_per(1000):
+            polygon = wkb.loads(str(data))
+            self.gids.append(gid)
+            self.polygons.append(polygon)
+            self.prepared.append(prep(polygon))
+        self.tree = STRtree(self.polygons)
+        self.position = dict((id(t), idx) for (idx, t) in enumerate(self.polygons))
+
+    def _candidates(self, area):
+        for hit in self.tree.query(area):
+            # older shapely returns the geometries, newer their positions
+            if getattr(hit, 'geom_type', None) is None:
+                yield int(hit)
+            else:
+                yield self.position[id(hit)]
+
+    def lookup(self, lon, lat):
+        "returns (True, gid or None) if the index can answer, otherwise (False, None)"
+        point = Point(lon, lat)
+        tol = self.tolerance
+        near = [idx for idx in self._candidates(box(lon - tol, lat - tol, lon + tol, lat + tol))
+                if self.polygons[idx].distance(point) <= tol]
+        if not near:
+            return True, None
+        within = [idx for idx in near if self.prepared[idx].contains(point)]
+        if len(within) == 1 and self.polygons[within[0]].boundary.distance(point) > tol:
+            return True, self.gids[within[0]]
+        return False, None
+
+
+def polygon_index(geometry_source):
+    "the PolygonIndex for @geometry_source, built on first use; None if one can't be used"
+    if STRtree is None:
+        return None
+    index = _indexes.get(geometry_source.id, False)
+    if index is False:
+        index = None
+        eal = EAlGIS()
+        tbl = table_class(geometry_source)
+        count = eal.db.session.query(sqlalchemy.func.count(getattr(tbl, geometry_source.gid))).scalar()
+        if count <= int(eal.get_setting('point_lookup_max_features', max_features)):
+            with metrics.phase_timer('point_index_build'):
+                index = PolygonIndex(geometry_source, float(eal.get_setting('point_lookup_tolerance', tolerance)))
+        _indexes.put(geometry_source.id, index)
+    return index
+
+
+@metrics.timed('point_lookup')
+def lookup_points(geometry_source, points):
+    "gid of the feature of @geometry_source containing each of @points (lon, lat); None where there is none"
+    index = polygon_index(geometry_source)
+    gids = []
+    for lon, lat in points:
+        if index is not None:
+            answered, gid = index.lookup(lon, lat)
+            if answered:
+                metrics.inc('ealgis_cache_total', cache='point_index', result='hit')
+                gids.append(gid)
+                continue
+            metrics.inc('ealgis_cache_total', cache='point_index', result='miss')
+        gids.append(db_lookup(geometry_source, lon, lat))
+    return gids
+
+
+def layer_expression(defn_obj, layer_id):
+    "compiled expression of a map layer, without geometry; reused while the layer is unchanged"
+    layer = defn_obj.get()['layers'][layer_id]
+    key = (defn_obj.id, layer_id, layer.get('hash'))
+    expr = _expressions.get(key)
+    if expr is None:
+        expr = defn_obj.compile_expr(layer, include_geometry=False)
+        _expressions.put(key, expr)
+    return expr
+
+
+def layer_sql(defn_obj, layer_id, kind):
+    """SQL of the query of a map layer, for a prepared statement; `value' takes a gid ($1),
+    `values' an array of gids ($1)"""
+    layer = defn_obj.get()['layers'][layer_id]
+
+    def _build():
+        expr = layer_expression(defn_obj, layer_id)
+        gid_attr = getattr(expr.tbl, expr.geometry_source.gid)
+        if kind == 'value':
+            return expr.get_query().filter(gid_attr == prepared.parameter(1))
+        return expr.get_query().filter(gid_attr == sqlalchemy.func.any(prepared.parameter(1)))
+    return prepared.statement_sql((defn_obj.id, layer_id, layer.get('hash'), kind), _build)
+
+
+def layer_value(defn_obj, layer_id, gid):
+    "q of the feature @gid of a map layer; cached while the layer is unchanged"
+    key = (defn_obj.id, layer_id, defn_obj.get()['layers'][layer_id].get('hash'), gid)
+    hit = _values.get(key, _values)
+    if hit is not _values:
+        metrics.inc('ealgis_cache_total', cache='layer_value', result='hit')
+        return hit
+    metrics.inc('ealgis_cache_total', cache='layer_value', result='miss')
+    row = prepared.execute(layer_sql(defn_obj, layer_id, 'value'), [gid]).first()
+    value = float(row[1]) if row is not None and row[1] is not None else None
+    _values.put(key, value)
+    return value
+
+
+def layer_values(defn_obj, layer_id, gids):
+    "returns {gid: q} for the features @gids of a map layer"
+    gids = [t for t in set(gids) if t is not None]
+    if not gids:
+        return {}
+    return dict(
+        (gid, float(q) if q is not None else None)
+        for (gid, q) in prepared.execute(layer_sql(defn_obj, layer_id, 'values'), [gids]))
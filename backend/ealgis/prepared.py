@@ -0,0 +1,77 @@
+
+#
+# server-side prepared statements, for the queries we run repeatedly with different
+# parameters (eg. the value of a layer for a gid, or its statistics within a box)
+#
+# a statement is prepared once on each database connection; executing it then skips
+# parsing and, once Postgres has settled upon a generic plan, planning. parameters
+# appear in the SQL as $1, $2, ... (see parameter()). the least recently used
+# statements on a connection are deallocated once there are more than the
+# `prepared_statements' setting of them
+#
+
+from hashlib import sha1
+import sqlalchemy
+from sqlalchemy.dialects.postgresql.base import PGDialect
+from db import EAlGIS
+from util import LRUCache
+import metrics
+
+max_statements = 64
+
+# caller's key (eg. map id, layer id, layer hash, kind of query) -> SQL
+_sql = LRUCache(1024)
+
+
+def parameter(n):
+    "placeholder for the @n'th (from 1) parameter of a prepared statement"
+    return sqlalchemy.literal_column('$%d' % (n))
+
+
+# the north-east and south-west corners ((lat, lon)) of a box, as parameters $1 to $4; see bounds_parameters()
+bounds_placeholders = ((parameter(4), parameter(3)), (parameter(2), parameter(1)))
+
+
+def bounds_parameters(bounds):
+    "values for bounds_placeholders, from @bounds; (lat, lon) of the north-east and south-west corners"
+    (ymax, xmax), (ymin, xmin) = bounds
+    return [xmin, ymin, xmax, ymax]
+
+
+def statement_sql(key, build):
+    "SQL of the query (or select) returned by @build(); reused for calls with the same @key"
+    sql = _sql.get(key)
+    if sql is None:
+        statement = build()
+        if isinstance(statement, sqlalchemy.orm.Query):
+            statement = statement.statement
+        # Postgres without the driver's escaping of `%' (for its parameters); see execute()
+        sql = unicode(statement.compile(dialect=PGDialect(), compile_kwargs={"literal_binds": True}))
+        _sql.put(key, sql)
+    return sql
+
+
+def execute(sql, params=()):
+    "execute @sql, with @params, as a statement prepared on the session's connection; returns the result"
+    eal = EAlGIS()
+    conn = eal.db.session.connection()
+    # statements without parameters are passed to the driver as they are, rather than
+    # having `%' interpreted as the start of a parameter
+    plain = conn.execution_options(no_parameters=True)
+    # the dictionary lives as long as the DBAPI connection, as do the statements prepared on it
+    prepared = conn.info.get('ealgis_prepared')
+    if prepared is None:
+        prepared = conn.info['ealgis_prepared'] = LRUCache(max(1, int(eal.get_setting('prepared_statements', max_statements))))
+    name = 'ealgis_%s' % (sha1(sql.encode('utf8')).hexdigest()[:24])
+    if prepared.get(name) is None:
+        metrics.inc('ealgis_cache_total', cache='prepared_statement', result='miss')
+        plain.execute('PREPARE %s AS %s' % (name, sql))
+        for discarded in prepared.put(name, True):
+            plain.execute('DEALLOCATE %s' % (discarded))
+    else:
+        metrics.inc('ealgis_cache_total', cache='prepared_statement', result='hit')
+    if not params:
+        return plain.execute('EXECUTE %s' % (name))
+    args = dict(('p%d' % (i), v) for (i, v) in enumerate(params))
+    return conn.execute(
+        sqlalchemy.text('EXECUTE %s(%s)' % (name, ', '.join(':p%d' % (i) for i in xrange(len(params))))), **args)
@@ -1,25 +1,41 @@
 import unittest
+import re
 
 
 class SequenceClassifier(object):
+    """determine the narrowest of int, float or str which can hold every value
+    in a sequence of strings. values are matched against regular expressions
+    (accepting what the PostgreSQL integer and double precision input
+    functions accept) rather than attempting casts"""
     casts = (int, float)
+    patterns = {
+        int: re.compile(r'^\s*[+-]?(\d+)\s*$'),
+        float: re.compile(r'^\s*[+-]?(\d+\.?\d*([eE][+-]?\d+)?|\.\d+([eE][+-]?\d+)?|nan|inf|infinity)\s*$', re.IGNORECASE),
+    }
+    int_max = 2 ** 31 - 1
 
     def __init__(self):
         self.possible = list(SequenceClassifier.casts)
 
+    @classmethod
+    def test(cls, cast, v):
+        m = cls.patterns[cast].match(v)
+        if m is None:
+            return False
+        # long digit strings might not fit in a postgresql integer
+        if cast is int and len(m.group(1)) > 9:
+            return abs(int(v)) <= cls.int_max
+        return True
+
     def update(self, v):
-        def test(cast):
-            try:
-                cast(v)
-            except ValueError:
-                return False
-            return True
-
-        ok = []
-        for cast in self.possible:
-            if test(cast):
-                ok.append(cast)
-        self.possible = ok
+        self.possible = [cast for cast in self.possible if SequenceClassifier.test(cast, v)]
+
+    def update_many(self, values):
+        "update with an iterable of values; stops examining values once they can only be str"
+        test = SequenceClassifier.test
+        for cast in list(self.possible):
+            if not all(test(cast, v) for v in values):
+                self.possible.remove(cast)
 
     def get(self):
         if len(self.possible) > 0:
@@ -27,12 +43,29 @@ class SequenceClassifier(object):
         return str
 
 
+def classify_columns(rows, ncolumns):
+    "given a list of rows, each a sequence of strings, classify each of the first `ncolumns' columns"
+    columns = zip(*rows) if rows else [()] * ncolumns
+    rv = []
+    for idx in xrange(ncolumns):
+        classifier = SequenceClassifier()
+        if idx < len(columns):
+            classifier.update_many(columns[idx])
+        rv.append(classifier.get())
+    return rv
+
+
 class TestSequenceClassifier(unittest.TestCase):
     def run_seq(self, s):
         c = SequenceClassifier()
         map(c.update, s)
         return c.get()
 
+    def run_many(self, s):
+        c = SequenceClassifier()
+        c.update_many(s)
+        return c.get()
+
     def test_float_seq(self):
         self.assertEqual(self.run_seq(["1.", "2.0", "3.0000", "4"]), float)
 
@@ -45,5 +78,24 @@ class TestSequenceClassifier(unittest.TestCase):
     def test_garbage_seq(self):
         self.assertEqual(self.run_seq(["1", "2", "3", "mongoose"]), str)
 
+    def test_float_exponent_seq(self):
+        self.assertEqual(self.run_seq(["-1", "+.5", "2e10", "3.5E-2"]), float)
+
+    def test_int_overflow_seq(self):
+        self.assertEqual(self.run_seq(["1", "2147483647"]), int)
+        self.assertEqual(self.run_seq(["1", "2147483648"]), float)
+
+    def test_empty_seq(self):
+        self.assertEqual(self.run_seq(["1", ""]), str)
+
+    def test_update_many(self):
+        for s in (["1", "2"], ["1", "2.5"], ["1", "x"]):
+            self.assertEqual(self.run_many(s), self.run_seq(s))
+
+    def test_classify_columns(self):
+        rows = [["1", "1.5", "a"], ["2", "2", "b"]]
+        self.assertEqual(classify_columns(rows, 3), [int, float, str])
+        self.assertEqual(classify_columns([], 2), [int, int])
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,6 +1,8 @@
 
 import subprocess as sp
 import itertools
+import collections
+import threading
 import os.path
 import os
 import re
@@ -28,6 +30,75 @@ def piperun(*cmds, **kwargs):
     return stdin, stderr, pipes[-1].returncode
 
 
+class IterStream(object):
+    "file-like object reading from an iterator of strings; eg. for feeding generated data to COPY FROM STDIN"
+    def __init__(self, it):
+        self._it = iter(it)
+        # strings read from the iterator, but not yet returned; the first is returned from _offset
+        self._chunks = collections.deque()
+        self._offset = 0
+        self._available = 0
+
+    def read(self, size=-1):
+        while size < 0 or self._available < size:
+            try:
+                chunk = next(self._it)
+            except StopIteration:
+                break
+            if chunk:
+                self._chunks.append(chunk)
+                self._available += len(chunk)
+        if size < 0 or size > self._available:
+            size = self._available
+        # only the data returned is copied, rather than everything left after it
+        rv = []
+        needed = size
+        while needed > 0:
+            chunk = self._chunks[0]
+            end = self._offset + needed
+            if end >= len(chunk):
+                rv.append(chunk[self._offset:] if self._offset else chunk)
+                needed -= len(chunk) - self._offset
+                self._chunks.popleft()
+                self._offset = 0
+            else:
+                rv.append(chunk[self._offset:end])
+                self._offset = end
+                needed = 0
+        self._available -= size
+        return ''.join(rv)
+
+
+class LRUCache(object):
+    "a mapping holding at most @maxsize items; the least recently used are discarded first"
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = value
+            return value
+
+    def put(self, key, value):
+        "returns the keys discarded to make room"
+        discarded = []
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.maxsize:
+                discarded.append(self._items.popitem(last=False)[0])
+        return discarded
+
+    def __len__(self):
+        return len(self._items)
+
+
 def alistdir(path):
     return (os.path.join(path, t) for t in os.listdir(path))
 